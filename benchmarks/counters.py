@@ -0,0 +1,78 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+"""
+Compares the throughput of concurrent increments of a single hot counter:
+``UPDATE ... SET votes = votes + 1`` on one Choice row, against increments
+of a ``StripedCounter`` spreading the same counter over several rows.
+
+Requires the sharded_polls databases, with the polls tables created.
+
+    python benchmarks/counters.py [threads] [increments per thread]
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sharded_polls.settings")
+
+from django.db import connections
+from django.db.models import F
+
+from sqlshards.db.shards.counters import StripedCounter
+from polls.models import Choice, ChoiceVoteStripe
+
+POLL_ID = 424242
+
+
+def bench(name, func, threads, number):
+    def run():
+        try:
+            for i in xrange(number):
+                func()
+        finally:
+            connections[Choice.objects.get_database_from_key(POLL_ID)].close()
+
+    workers = [threading.Thread(target=run) for i in xrange(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    seconds = time.time() - start
+    print '%-30s %8.0f increments/s' % (name, threads * number / seconds)
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    number = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    choice = Choice.objects.create(poll_id=POLL_ID, choice_text='Hot', votes=0)
+    try:
+        bench('single row', lambda: Choice.objects.filter(poll_id=POLL_ID, pk=choice.pk) \
+            .update(votes=F('votes') + 1), threads, number)
+        for stripes in (4, 16):
+            counter = StripedCounter(ChoiceVoteStripe, 'choice_id', stripes=stripes)
+            bench('%d stripes' % (stripes,), lambda: counter.incr(POLL_ID, choice.pk), threads, number)
+            ChoiceVoteStripe.objects.filter(poll_id=POLL_ID).delete()
+    finally:
+        choice.delete()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+"""
+Measures the per-query overhead of routing a partitioned model's queries.
+
+The legacy implementations below are what routing looked like before
+routing tables were precomputed (string building on every call).
+
+    python benchmarks/routing.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sharded_polls.settings")
+
+from django.db import connections
+
+from polls.models import Choice
+from sqlshards.db.shards.routers import ShardedRouter
+
+NUMBER = 200000
+
+
+def legacy_get_database(shard_info, slave=False):
+    parent = shard_info.parent._shards
+    if not parent.size:
+        return
+    alias = parent.cluster
+    if slave:
+        alias += '.slave'
+    alias += '.shard%d' % (shard_info.num % parent.size,)
+    return alias
+
+
+def legacy_get_model_from_key(model, key):
+    shards = model._shards
+    return shards.nodes[key % shards.num_shards]
+
+
+def legacy_get_database_from_key(model, key, slave=False):
+    try:
+        node = model._shards.nodes[key % model._shards.num_shards]
+    except IndexError:
+        raise ValueError
+    return legacy_get_database(node._shards, slave=slave)
+
+
+def legacy_db_for_read(model, **hints):
+    shard_info = getattr(model, '_shards', None)
+    if shard_info:
+        if not shard_info.is_child:
+            raise ValueError
+        return legacy_get_database(shard_info)
+
+
+def bench(name, func):
+    seconds = min(timeit.repeat(func, number=NUMBER, repeat=3))
+    print '%-40s %8.3f us/call' % (name, seconds / NUMBER * 1e6)
+
+
+def main():
+    router = ShardedRouter()
+    node = Choice._shards.nodes[1]
+    manager = Choice.objects
+
+    bench('get_model_from_key (legacy)', lambda: legacy_get_model_from_key(Choice, 12345))
+    bench('get_model_from_key', lambda: manager.get_model_from_key(12345))
+    bench('get_database_from_key (legacy)', lambda: legacy_get_database_from_key(Choice, 12345))
+    bench('get_database_from_key', lambda: manager.get_database_from_key(12345))
+    bench('db_for_read (legacy)', lambda: legacy_db_for_read(node))
+    bench('db_for_read', lambda: router.db_for_read(node))
+
+    # Queries filtering on the key (or saving an instance) are routed through
+    # the directory, which the legacy router didn't have
+    choice = Choice(poll_id=12345, choice_text='Yes', votes=0)
+    lookups = {'poll_id': 12345}
+    bench('db_for_read, exact_lookups (legacy)', lambda: legacy_get_database_from_key(Choice, lookups['poll_id']))
+    bench('db_for_read, exact_lookups', lambda: router.db_for_read(node, exact_lookups=lookups))
+    bench('db_for_read, instance', lambda: router.db_for_read(node, instance=choice))
+    bench('db_for_write, instance', lambda: router.db_for_write(node, instance=choice))
+
+    # Shards with replicas also check for transactions and recent writes
+    replicated = ShardedRouter()
+    replicated._replicas = dict((alias, [alias.replace('.shard', '.slave.shard')])
+                                for alias in connections.databases if '.shard' in alias)
+    bench('db_for_read, exact_lookups, replicas', lambda: replicated.db_for_read(node, exact_lookups=lookups))
+    bench('db_for_read, instance, replicas', lambda: replicated.db_for_read(node, instance=choice))
+    bench('db_for_write, instance, replicas', lambda: replicated.db_for_write(node, instance=choice))
+
+
+if __name__ == '__main__':
+    main()
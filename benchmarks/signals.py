@@ -0,0 +1,81 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+"""
+Measures instantiating rows of a partition, whose signals are re-sent to
+the partitioned model, with the legacy receiver (which always re-sends)
+and the current one (which skips re-sending without receivers).
+
+    python benchmarks/signals.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sharded_polls.settings")
+
+from django.db.models import signals
+from django.dispatch.dispatcher import _make_id
+
+from polls.models import Choice
+from sqlshards.db.shards.models import RESENT_SIGNALS, resend_signal
+
+NUMBER = 100000
+
+
+def legacy_resend_signal(new_sender):
+    def wrapped(**kwargs):
+        signal = kwargs.pop('signal')
+        kwargs['sender'] = new_sender
+        signal.send(**kwargs)
+    return wrapped
+
+
+def use_receiver(partition, receiver):
+    for signal in RESENT_SIGNALS:
+        for old in signal._live_receivers(_make_id(partition)):
+            signal.disconnect(old, sender=partition)
+        signal.connect(receiver, sender=partition, weak=False)
+
+
+def bench(name, func):
+    seconds = min(timeit.repeat(func, number=NUMBER, repeat=3))
+    print '%-40s %8.3f us/row' % (name, seconds / NUMBER * 1e6)
+
+
+def main():
+    partition = Choice._shards.nodes[0]
+    current = resend_signal(Choice)
+    legacy = legacy_resend_signal(Choice)
+
+    def receiver(sender, **kwargs):
+        pass
+
+    row = lambda: partition(poll_id=2, choice_text='Yes', votes=0)
+    for listening in (False, True):
+        if listening:
+            signals.post_init.connect(receiver, sender=Choice)
+        suffix = ' (with receiver)' if listening else ''
+
+        use_receiver(partition, legacy)
+        bench('instantiate (legacy)' + suffix, row)
+        use_receiver(partition, current)
+        bench('instantiate' + suffix, row)
+
+
+if __name__ == '__main__':
+    main()
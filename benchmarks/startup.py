@@ -0,0 +1,75 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+"""
+Measures the cost of declaring a partitioned model with many partitions,
+with every partition generated upfront and with SHARD_LAZY_PARTITIONS.
+
+    python benchmarks/startup.py [partitions]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sharded_polls.settings")
+
+from django.conf import settings
+from django.db import models
+
+from sqlshards.db.shards.models import PartitionModel
+
+_counter = [0]
+
+
+def declare(num_shards):
+    _counter[0] += 1
+
+    class Shards:
+        key = 'key'
+        cluster = 'sharded'
+    Shards.num_shards = num_shards
+
+    return type('StartupModel%d' % (_counter[0],), (PartitionModel,), {
+        '__module__': __name__,
+        'key': models.IntegerField(),
+        'Shards': Shards,
+        'Meta': type('Meta', (object,), {'app_label': 'benchmarks'}),
+    })
+
+
+def bench(name, num_shards, lazy):
+    settings.SHARD_LAZY_PARTITIONS = lazy
+    start = time.time()
+    model = declare(num_shards)
+    declared = time.time() - start
+
+    start = time.time()
+    model.objects.get_model_from_key(12345)
+    first_use = time.time() - start
+
+    print '%-10s declare %8.1f ms   first query %6.2f ms   %s' % (
+        name, declared * 1000, first_use * 1000, model._shards.nodes)
+
+
+def main():
+    num_shards = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    bench('eager', num_shards, False)
+    bench('lazy', num_shards, True)
+
+
+if __name__ == '__main__':
+    main()
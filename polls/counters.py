@@ -0,0 +1,75 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from django.conf import settings
+from django.db.models import F
+
+from sqlshards.db.shards.counters import IncrementBuffer, StripedCounter, post_flush
+from polls.models import Choice, ChoiceVoteStripe
+
+
+def get_vote_stripes():
+    """
+    Returns the striped counter votes are added to, as configured by the
+    ``POLLS_VOTE_STRIPES`` setting, or ``None`` to add them to
+    ``Choice.votes``.
+    """
+    options = getattr(settings, 'POLLS_VOTE_STRIPES', None)
+    if options is None:
+        return None
+    return StripedCounter(ChoiceVoteStripe, 'choice_id', **options)
+
+
+def get_vote_buffer():
+    """
+    Returns the buffer votes are counted through, as configured by the
+    ``POLLS_VOTE_BUFFER`` setting, or ``None`` to update votes directly.
+    """
+    options = getattr(settings, 'POLLS_VOTE_BUFFER', None)
+    if options is None:
+        return None
+    return IncrementBuffer(Choice, 'votes', counter=vote_stripes, **options)
+
+vote_stripes = get_vote_stripes()
+vote_buffer = get_vote_buffer()
+
+
+def incr_votes(choice):
+    """
+    Counts a vote for ``choice``.
+    """
+    if vote_buffer is not None:
+        vote_buffer.incr(choice.poll_id, choice.pk)
+        return
+
+    if vote_stripes is not None:
+        vote_stripes.incr(choice.poll_id, choice.pk)
+    else:
+        Choice.objects.filter(pk=choice.pk, poll_id=choice.poll_id).update(votes=F('votes') + 1)
+    # As the buffer would once it writes the vote
+    post_flush.send(sender=Choice, counts={(choice.poll_id, choice.pk): 1})
+
+
+def get_votes(poll_id, choices):
+    """
+    Returns a dictionary mapping the pk of each of ``choices`` (of the poll
+    ``poll_id``) to its number of votes.
+    """
+    votes = dict((c.pk, c.votes) for c in choices)
+    if vote_stripes is not None:
+        for pk, value in vote_stripes.get_many(poll_id, votes.keys()).iteritems():
+            votes[pk] += value
+    return votes
@@ -54,3 +54,15 @@ class Choice(PollPartitionBase):
 
     choice_text = models.CharField(max_length=200)
     votes = models.IntegerField()
+
+
+class ChoiceVoteStripe(PollPartitionBase):
+    """
+    Stripes of a choice's vote count, see ``polls.counters``.
+    """
+    choice_id = models.PositiveIntegerField()
+    stripe = models.PositiveSmallIntegerField()
+    value = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('poll_id', 'choice_id', 'stripe'),)
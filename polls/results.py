@@ -0,0 +1,150 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import signals
+
+from sqlshards.db.shards.counters import post_flush
+from polls.counters import get_votes
+from polls.models import Choice, Poll
+
+#: Seconds a poll's results are served before being regenerated.
+RESULTS_TIMEOUT = getattr(settings, 'POLLS_RESULTS_TIMEOUT', 30)
+
+#: Seconds expired results are kept around, served while they're regenerated.
+STALE_TIMEOUT = getattr(settings, 'POLLS_RESULTS_STALE_TIMEOUT', 300)
+
+#: Seconds results are served before votes being written expires them, so a
+#: busy poll is regenerated at most this often.
+MIN_AGE = getattr(settings, 'POLLS_RESULTS_MIN_AGE', 5)
+
+#: Seconds a regeneration may take before another request takes over.
+LOCK_TIMEOUT = 10
+
+#: Seconds a request waits for another to generate results nobody has cached.
+LOCK_WAIT = getattr(settings, 'POLLS_RESULTS_LOCK_WAIT', 1.0)
+
+LOCK_POLL_INTERVAL = 0.05
+
+
+def get_cache_key(poll_id):
+    return 'polls:results:%d' % (int(poll_id),)
+
+
+def build_results(poll_id):
+    """
+    Reads the results of the poll ``poll_id`` from the databases.
+    """
+    poll = Poll.objects.get(pk=poll_id)
+    choices = list(Choice.objects.filter(poll_id=poll.pk).order_by('pk'))
+    votes = get_votes(poll.pk, choices)
+    return {
+        'id': poll.pk,
+        'question': poll.question,
+        'choices': [{'id': c.pk, 'choice_text': c.choice_text, 'votes': votes[c.pk]} for c in choices],
+    }
+
+
+def get_results(poll_id, wait=None):
+    """
+    Returns the results of the poll ``poll_id``, from the cache if possible.
+
+    Results expire after ``RESULTS_TIMEOUT`` seconds, after which a single
+    request (the one which acquires the lock) regenerates them, while others
+    keep being served the expired copy. When there's no copy at all, others
+    wait up to ``wait`` seconds (``LOCK_WAIT`` by default) for it to appear,
+    then read the results themselves without caching them.
+
+    Raises ``Poll.DoesNotExist`` for unknown polls.
+    """
+    key = get_cache_key(poll_id)
+    lock_key = key + ':lock'
+    token = uuid.uuid4().hex
+    entry = cache.get(key)
+    if entry is not None:
+        expires, results = entry
+        if expires > time.time() or not cache.add(lock_key, token, LOCK_TIMEOUT):
+            return results
+    elif not cache.add(lock_key, token, LOCK_TIMEOUT):
+        entry = wait_for_results(key, LOCK_WAIT if wait is None else wait)
+        if entry is not None:
+            return entry[1]
+        return build_results(poll_id)
+
+    try:
+        results = build_results(poll_id)
+        cache.set(key, (time.time() + RESULTS_TIMEOUT, results), RESULTS_TIMEOUT + STALE_TIMEOUT)
+    finally:
+        # Our lock may have timed out and been taken by another request
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
+    return results
+
+
+def wait_for_results(key, wait):
+    """
+    Polls the cache for the entry at ``key`` for up to ``wait`` seconds,
+    returning None if it doesn't appear.
+    """
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+    return None
+
+
+def expire_results(poll_id):
+    """
+    Marks the cached results of the poll ``poll_id`` as expired, so they're
+    regenerated by the next request.
+    """
+    key = get_cache_key(poll_id)
+    entry = cache.get(key)
+    if entry is not None:
+        cache.set(key, (0, entry[1]), STALE_TIMEOUT)
+
+
+def expire_results_for_choice(sender, instance, **kwargs):
+    expire_results(instance.poll_id)
+
+
+def expire_results_for_votes(sender, counts, **kwargs):
+    """
+    Expires the cached results of polls whose votes were written, unless
+    they were generated less than ``MIN_AGE`` seconds ago.
+
+    The cached copy isn't patched in place, as concurrent flushes would race
+    between reading and writing it back and lose votes.
+    """
+    now = time.time()
+    for poll_id in set(poll_id for poll_id, choice_id in counts):
+        key = get_cache_key(poll_id)
+        entry = cache.get(key)
+        if entry is None:
+            continue
+        expires, results = entry
+        if now < expires <= now + RESULTS_TIMEOUT - MIN_AGE:
+            cache.set(key, (0, results), STALE_TIMEOUT)
+
+signals.post_save.connect(expire_results_for_choice, sender=Choice)
+signals.post_delete.connect(expire_results_for_choice, sender=Choice)
+post_flush.connect(expire_results_for_votes, sender=Choice)
@@ -15,12 +15,19 @@
 """
 
 import datetime
+import os
+import shutil
+import tempfile
 
+from django.core.cache import cache
 from django.utils import timezone
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.core.urlresolvers import reverse
 
-from polls.models import Poll
+from sqlshards.db.shards.counters import IncrementBuffer, StripedCounter, post_flush
+from polls.models import Choice, ChoiceVoteStripe, Poll
+from polls.results import MIN_AGE, get_cache_key, get_results
 
 def create_poll(question, days):
     """
@@ -131,3 +138,137 @@ class PollIndexDetailTests(TestCase):
         past_poll = create_poll(question='Past Poll.', days=-5)
         response = self.client.get(reverse('polls:detail', args=(past_poll.id,)))
         self.assertContains(response, past_poll.question, status_code=200)
+
+# Flushes are written on the pool's connections otherwise, outside the test's
+# transaction, and would leak into later tests
+@override_settings(SHARD_MAX_WORKERS=1)
+class VoteBufferTests(TestCase):
+    def setUp(self):
+        self.journal = tempfile.mkdtemp()
+        self.buffer = IncrementBuffer(Choice, 'votes', interval=None, journal=self.journal)
+        self.choices = [Choice.objects.create(poll_id=poll_id, choice_text='Yes', votes=0)
+                        for poll_id in (1, 2)]
+
+    def tearDown(self):
+        shutil.rmtree(self.journal)
+
+    def get_votes(self, choice):
+        return Choice.objects.get(poll_id=choice.poll_id, pk=choice.pk).votes
+
+    def test_flush_coalesces_increments(self):
+        """
+        Increments are held until flushed, then written per partition.
+        """
+        for choice in self.choices * 3:
+            self.buffer.incr(choice.poll_id, choice.pk)
+        self.assertEqual(len(self.buffer.pending), 2)
+        self.assertEqual(self.get_votes(self.choices[0]), 0)
+
+        self.buffer.flush()
+        self.assertEqual([self.get_votes(c) for c in self.choices], [3, 3])
+        self.assertEqual(os.listdir(self.journal), [])
+
+    def test_recovers_journal_of_crashed_process(self):
+        """
+        Increments journaled by a process which died before flushing are
+        written by the next flush.
+        """
+        choice = self.choices[0]
+        path = os.path.join(self.journal, '%s.1.1.log' % (self.buffer.journal.name,))
+        with open(path, 'w') as fp:
+            fp.write('%d %d 2\n%d %d 3\n' % (choice.poll_id, choice.pk, choice.poll_id, choice.pk))
+
+        self.buffer.flush()
+        self.assertEqual(self.get_votes(choice), 5)
+        self.assertFalse(os.path.exists(path))
+
+@override_settings(SHARD_MAX_WORKERS=1)
+class StripedCounterTests(TestCase):
+    def setUp(self):
+        self.counter = StripedCounter(ChoiceVoteStripe, 'choice_id', stripes=4)
+
+    def test_incr(self):
+        """
+        Increments spread over the stripes add up.
+        """
+        for i in xrange(20):
+            self.counter.incr(1, 10)
+        self.counter.incr(1, 11, 5)
+        self.assertTrue(1 < ChoiceVoteStripe.objects.filter(poll_id=1).count() <= 5)
+        self.assertEqual(self.counter.get(1, 10), 20)
+        self.assertEqual(self.counter.get_many(1, [10, 11, 12]), {10: 20, 11: 5, 12: 0})
+
+    def test_buffered(self):
+        """
+        A buffer writing to a striped counter creates and updates stripes.
+        """
+        buffer = IncrementBuffer(Choice, 'votes', interval=None, counter=self.counter)
+        for i in xrange(2):
+            buffer.incr(1, 10, 3)
+            buffer.incr(2, 10)
+            buffer.flush()
+        self.assertEqual(self.counter.get(1, 10), 6)
+        self.assertEqual(self.counter.get(2, 10), 2)
+
+class PollResultsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.poll = create_poll(question='Cached?', days=-1)
+        self.choice = Choice.objects.create(poll_id=self.poll.pk, choice_text='Yes', votes=2)
+
+    def get_results_page(self):
+        return self.client.get(reverse('polls:results', args=(self.poll.id,)))
+
+    def test_results_are_cached(self):
+        """
+        Results are served from the cache, and regenerated once votes are
+        written (at most every MIN_AGE seconds) or a choice changes.
+        """
+        self.assertContains(self.get_results_page(), 'Yes == 2 vote')
+        Poll.objects.filter(pk=self.poll.pk).update(question='Changed?')
+        self.assertContains(self.get_results_page(), 'Cached?')
+
+        Choice.objects.filter(pk=self.choice.pk, poll_id=self.poll.pk).update(votes=5)
+        post_flush.send(sender=Choice, counts={(self.poll.pk, self.choice.pk): 3})
+        self.assertContains(self.get_results_page(), 'Cached?')
+
+        # Age the cached results past MIN_AGE
+        key = get_cache_key(self.poll.pk)
+        expires, results = cache.get(key)
+        cache.set(key, (expires - MIN_AGE, results))
+        post_flush.send(sender=Choice, counts={(self.poll.pk, self.choice.pk): 3})
+        response = self.get_results_page()
+        self.assertContains(response, 'Changed?')
+        self.assertContains(response, 'Yes == 5 vote')
+
+        Poll.objects.filter(pk=self.poll.pk).update(question='Changed again?')
+        self.choice.save()
+        response = self.get_results_page()
+        self.assertContains(response, 'Changed again?')
+        self.assertContains(response, 'Yes == 2 vote')
+
+    def test_expired_results_served_while_regenerating(self):
+        """
+        Only the request which acquires the lock regenerates expired results.
+        """
+        key = get_cache_key(self.poll.pk)
+        cache.set(key, (0, {'id': self.poll.pk, 'question': 'Stale?', 'choices': []}))
+        cache.add(key + ':lock', 1)
+        self.assertEqual(get_results(self.poll.pk)['question'], 'Stale?')
+        cache.delete(key + ':lock')
+        self.assertEqual(get_results(self.poll.pk)['question'], 'Cached?')
+
+    def test_missing_results_not_cached_without_lock(self):
+        """
+        Requests which don't hold the lock neither cache results nor release
+        the lock of the request regenerating them.
+        """
+        key = get_cache_key(self.poll.pk)
+        cache.add(key + ':lock', 'other')
+        self.assertEqual(get_results(self.poll.pk, wait=0)['question'], 'Cached?')
+        self.assertEqual(cache.get(key), None)
+        self.assertEqual(cache.get(key + ':lock'), 'other')
+
+    def test_results_for_missing_poll(self):
+        response = self.client.get(reverse('polls:results', args=(self.poll.id + 1,)))
+        self.assertEqual(response.status_code, 404)
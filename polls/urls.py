@@ -36,11 +36,7 @@ urlpatterns = patterns('',
             template_name='polls/detail.html'),
         name='detail'),
     # Ex: /polls/5/results/
-    url(r'^(?P<pk>\d+)/results/$',
-        DetailView.as_view(
-            model=Poll,
-            template_name='polls/results.html'),
-        name='results'),
+    url(r'^(?P<poll_id>\d+)/results/$', 'polls.views.results', name='results'),
     # Ex: /polls/5/vote/
     url(r'^(?P<poll_id>\d+)/vote/$', 'polls.views.vote', name='vote'),
 )
@@ -15,10 +15,12 @@
 """
 
 from django.shortcuts import get_object_or_404, render_to_response
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import Http404, HttpResponseRedirect, HttpResponse
 from django.core.urlresolvers import reverse
 from django.template import RequestContext
+from polls.counters import incr_votes
 from polls.models import Choice, Poll
+from polls.results import get_results
 
 
 def vote(request, poll_id):
@@ -32,8 +34,18 @@ def vote(request, poll_id):
             'error_message': "You didn't select a choice.",
         }, context_instance=RequestContext(request))
     else:
-        Choice.objects.filter(pk=pk, poll_id=p.pk).update(votes=F('votes') + 1)
+        incr_votes(selected_choice)
         # Always return an HttpResponseRedirect after successfully dealing
         # with POST data. This prevents data from being posted twice if a
         # user hits the Back button.
         return HttpResponseRedirect(reverse('polls:results', args=(p.id,)))
+
+
+def results(request, poll_id):
+    try:
+        results = get_results(poll_id)
+    except Poll.DoesNotExist:
+        raise Http404
+    return render_to_response('polls/results.html', {
+        'results': results,
+    }, context_instance=RequestContext(request))
@@ -56,6 +56,41 @@ DATABASE_ROUTERS = ['sqlshards.db.shards.routers.ShardedRouter']
 SHARD_EPOCH = int(time.mktime(datetime(2012, 11, 1).timetuple()) * 1000)
 DEFAULT_SHARD_COUNT = 2
 
+# Maps the virtual buckets of each cluster onto its physical shards, see
+# sqlshards.db.shards.directory.ShardDirectory
+SHARD_DIRECTORY = {
+    'sharded': {
+        'buckets': 4096,
+    },
+}
+
+# Counts votes in process and writes them in batches (see
+# sqlshards.db.shards.counters.IncrementBuffer) rather than writing each vote
+# as it's cast, e.g.:
+#
+#   POLLS_VOTE_BUFFER = {
+#       'max_pending': 1000,
+#       'interval': 1.0,
+#       'journal': '/var/spool/sharded_polls/votes',
+#   }
+#
+# Votes held when a process dies are lost unless a journal is configured.
+# Journals are replayed at-least-once: a process dying between writing a
+# partition and recording it in its journal has that partition's votes
+# counted again by the next flush.
+POLLS_VOTE_BUFFER = None
+
+# Spreads each choice's votes over rows of ChoiceVoteStripe rather than adding
+# them to Choice.votes (read them with polls.counters.get_votes), e.g.:
+#
+#   POLLS_VOTE_STRIPES = {'stripes': 8, 'cache_ttl': 5}
+POLLS_VOTE_STRIPES = None
+
+# Set to True to generate the model for each partition on first use rather
+# than at import (syncdb still creates every partition's table).  Partitions
+# can then no longer be imported by name, e.g. Choice_Partition0.
+SHARD_LAZY_PARTITIONS = False
+
 # Hosts/domain names that are valid for this site; required if DEBUG is False
 # See https://docs.djangoproject.com/en/1.5/ref/settings/#allowed-hosts
 ALLOWED_HOSTS = []
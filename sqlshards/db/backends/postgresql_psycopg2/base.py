@@ -0,0 +1,82 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import threading
+
+from django.db.backends.postgresql_psycopg2.base import *  # NOQA
+from django.db.backends.postgresql_psycopg2.base import DatabaseWrapper as BaseDatabaseWrapper
+from django.db.backends.signals import connection_created
+
+_local = threading.local()
+
+
+def get_shared_connections():
+    """
+    Returns the current thread's open connections, keyed by the server and
+    database they're connected to.
+    """
+    try:
+        return _local.connections
+    except AttributeError:
+        _local.connections = {}
+        return _local.connections
+
+
+class DatabaseWrapper(BaseDatabaseWrapper):
+    """
+    A PostgreSQL backend which shares a single connection (per thread) between
+    every alias pointing at the same server and database.
+
+    Logical shards (``<cluster>.shardN``) placed on the same host keep their
+    partitions apart by table name, so they can be served over one connection,
+    and the number of connections a worker holds scales with the number of
+    hosts rather than shards.  As the connection is shared, committing or
+    rolling back through one alias affects every alias on that host.
+
+    ``connection_created`` is sent for every alias, whether it opened the
+    connection or attached to one already open.
+    """
+    def get_host_key(self):
+        settings_dict = self.settings_dict
+        return (settings_dict['HOST'], settings_dict['PORT'], settings_dict['NAME'], settings_dict['USER'])
+
+    def _cursor(self):
+        shared = get_shared_connections()
+        key = self.get_host_key()
+
+        # Another alias may have closed the shared connection
+        if self.connection is not None and self.connection.closed:
+            self.connection = None
+        attached = False
+        if self.connection is None:
+            connection = shared.get(key)
+            if connection is not None and not connection.closed:
+                self.connection = connection
+                attached = True
+
+        cursor = super(DatabaseWrapper, self)._cursor()
+        shared[key] = self.connection
+        if attached:
+            # The base class only sends it when opening a new connection
+            connection_created.send(sender=self.__class__, connection=self)
+        return cursor
+
+    def close(self):
+        shared = get_shared_connections()
+        key = self.get_host_key()
+        if self.connection is not None and shared.get(key) is self.connection:
+            del shared[key]
+        super(DatabaseWrapper, self).close()
@@ -0,0 +1,436 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import atexit
+import fcntl
+import glob
+import logging
+import os
+import random
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import connections, transaction, IntegrityError
+from django.db.models import F, Sum
+from django.dispatch import Signal
+
+from sqlshards.db.shards.pool import run_parallel
+
+logger = logging.getLogger('sqlshards.counters')
+
+#: Sent (with the partitioned model as sender) once a batch of increments
+#: has been written, with ``counts`` mapping ``(key, pk)`` to the delta.
+post_flush = Signal(providing_args=['counts'])
+
+
+class Journal(object):
+    """
+    Append-only log of the increments held by an ``IncrementBuffer``, so they
+    can be replayed if the process dies before flushing them.
+
+    Each process appends to its own file in ``directory``, which it holds an
+    exclusive lock on.  A file which can be locked by someone else therefore
+    belongs to a dead process, and is picked up by ``recover``.
+
+    Increments are written as ``<key> <pk> <delta>`` lines.  While a batch is
+    being flushed, ``done <table> <alias>`` lines record the partitions which
+    were already written, so a recovered batch doesn't apply them twice.
+    Replay is still at-least-once, as a partition written just before the
+    process died may not have been marked done yet.
+    """
+    def __init__(self, directory, name, sync=False):
+        self.directory = directory
+        self.name = name
+        self.sync = sync
+        self.fp = None
+        self._lock = threading.Lock()
+
+    def open(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, '%s.%d.%d.log' % (self.name, os.getpid(), time.time() * 1000000))
+        fp = open(path, 'a')
+        fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return fp
+
+    def write(self, fp, line):
+        with self._lock:
+            fp.write(line + '\n')
+            fp.flush()
+            if self.sync:
+                os.fsync(fp.fileno())
+
+    def append(self, key, pk, delta):
+        if self.fp is None:
+            self.fp = self.open()
+        self.write(self.fp, '%d %d %d' % (key, pk, delta))
+
+    def rotate(self):
+        """
+        Starts a new file, returning the current one (or ``None``), whose
+        increments are about to be flushed.
+        """
+        fp, self.fp = self.fp, None
+        return fp
+
+    def mark_done(self, fp, table, alias):
+        self.write(fp, 'done %s %s' % (table, alias))
+
+    def discard(self, fp):
+        os.unlink(fp.name)
+        fp.close()
+
+    def recover(self):
+        """
+        Yields ``(fp, counts, done)`` for every file left behind by a dead
+        process, where ``done`` is the set of ``(table, alias)`` pairs which
+        were already written.
+        """
+        own = self.fp.name if self.fp is not None else None
+        for path in sorted(glob.glob(os.path.join(self.directory, '%s.*.log' % (self.name,)))):
+            if path == own:
+                continue
+            try:
+                fp = open(path, 'r+')
+            except IOError:
+                # Discarded in the meantime
+                continue
+            try:
+                fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                fp.close()
+                continue
+
+            counts = {}
+            done = set()
+            for line in fp:
+                parts = line.split()
+                if len(parts) == 3 and parts[0] == 'done':
+                    done.add((parts[1], parts[2]))
+                elif len(parts) == 3:
+                    key, pk, delta = map(int, parts)
+                    counts[(key, pk)] = counts.get((key, pk), 0) + delta
+                # Anything else is a line cut short by the crash
+            fp.seek(0, os.SEEK_END)
+            yield fp, counts, done
+
+
+class IncrementBuffer(object):
+    """
+    Coalesces increments of the integer ``field`` of a partitioned ``model``
+    in process, writing them in batches: a single ``UPDATE ... FROM (VALUES
+    ...)`` per partition, with the partitions written in parallel.
+
+    A batch is written by a background thread every ``interval`` seconds, or
+    as soon as ``max_pending`` distinct rows have pending increments.  With
+    ``interval=None`` no thread is started, and ``flush`` must be called.
+
+    If ``journal`` (a directory) is given, increments are also appended to a
+    local file before being acknowledged, and files left behind by crashed
+    processes are replayed on the next flush (see ``Journal``).  Pass
+    ``sync=True`` to ``fsync`` every increment, to also survive the machine
+    going down.
+
+    Increments are written to ``field`` itself, or to ``counter``, a
+    ``StripedCounter``, if given.
+
+    >>> votes = IncrementBuffer(Choice, 'votes', journal='/var/spool/polls')
+    >>> votes.incr(poll_id, choice_id)
+    """
+    def __init__(self, model, field, max_pending=1000, interval=1.0, journal=None, sync=False, name=None,
+                 counter=None):
+        shards = model._shards
+        assert len(shards.key) == 1, 'IncrementBuffer requires %s models to have a single shard key.' % (
+            model.__name__,)
+        self.model = model
+        self.field = model._meta.get_field(field)
+        self.max_pending = max_pending
+        self.interval = interval
+        self.counter = counter
+        self.pending = {}
+        self.journal = None
+        if journal:
+            self.journal = Journal(journal, name or '%s.%s' % (model._meta.db_table, self.field.column), sync=sync)
+        self._recovered = False
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.flush)
+
+    def __repr__(self):
+        return u'<%s: model=%s, field=%s, pending=%s>' % (
+            self.__class__.__name__, self.model.__name__, self.field.name, len(self.pending))
+
+    def incr(self, key, pk, delta=1):
+        """
+        Adds ``delta`` to ``field`` of the row ``pk``, routed by ``key``.
+        """
+        key, pk = int(key), int(pk)
+        with self._lock:
+            if self.journal is not None:
+                self.journal.append(key, pk, delta)
+            self.pending[(key, pk)] = self.pending.get((key, pk), 0) + delta
+            full = len(self.pending) >= self.max_pending
+
+        self.start()
+        if full:
+            self._wakeup.set()
+
+    def start(self):
+        """
+        Starts the background flushing thread (again, if the process forked).
+        """
+        if self.interval is None or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='IncrementBuffer(%s)' % (self.model.__name__,))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed to flush %r', self)
+
+    def flush(self):
+        """
+        Writes all pending increments, and replays the journals of crashed
+        processes the first time it's called.  Increments which fail to be
+        written are put back to be retried by the next flush.
+
+        Partitions are written (and committed) in parallel on the connections
+        of the shared pool (see ``run_parallel``), so a flush never joins the
+        caller's transaction.  Only with ``SHARD_MAX_WORKERS = 1`` are they
+        written inline on the caller's connections.
+        """
+        with self._flush_lock:
+            if self.journal is not None and not self._recovered:
+                self._recovered = True
+                for fp, counts, done in self.journal.recover():
+                    self.write(counts, fp, done)
+
+            with self._lock:
+                counts, self.pending = self.pending, {}
+                fp = self.journal.rotate() if self.journal is not None else None
+            if counts or fp is not None:
+                self.write(counts, fp)
+
+    def write(self, counts, fp=None, done=()):
+        """
+        Applies ``counts``, mapping ``(key, pk)`` to a delta, one partition at
+        a time.  Progress is recorded in the journal file ``fp``, which is
+        removed once every partition has been handled.
+        """
+        manager = (self.counter.model if self.counter is not None else self.model).objects
+        groups = {}
+        for (key, pk), delta in counts.iteritems():
+            if not delta:
+                continue
+            location = (manager.get_model_from_key(key), manager.get_database_from_key(key))
+            if (location[0]._meta.db_table, location[1]) in done:
+                continue
+            groups.setdefault(location, []).append((key, pk, delta))
+
+        def write_partition(model, alias, rows):
+            try:
+                self.write_partition(model, alias, rows)
+            except Exception:
+                logger.exception('Failed to write %d increments to %s on %s', len(rows), model._meta.db_table, alias)
+                # Put them back (into the current journal file) to be retried
+                for key, pk, delta in rows:
+                    self.incr(key, pk, delta)
+                return rows
+            finally:
+                if fp is not None:
+                    self.journal.mark_done(fp, model._meta.db_table, alias)
+
+        tasks = [(alias, write_partition, (model, alias, rows)) for (model, alias), rows in groups.iteritems()]
+        failed = set((key, pk) for rows in run_parallel(tasks) if rows for key, pk, delta in rows)
+
+        if fp is not None:
+            self.journal.discard(fp)
+
+        written = dict(((key, pk), delta) for rows in groups.itervalues() for key, pk, delta in rows
+                       if (key, pk) not in failed)
+        if written:
+            post_flush.send(sender=self.model, counts=written)
+
+    def write_partition(self, model, alias, rows):
+        """
+        Adds the ``(key, pk, delta)`` ``rows`` to the partition ``model`` on
+        database ``alias`` in a single statement.
+        """
+        if self.counter is not None:
+            return self.counter.write_partition(model, alias, rows)
+
+        connection = connections[alias]
+        qn = connection.ops.quote_name
+        opts = model._meta
+        key_field = opts.get_field(model._shards.key[0])
+        column = qn(self.field.column)
+
+        sql = 'UPDATE %(table)s SET %(column)s = %(table)s.%(column)s + v.delta ' \
+              'FROM (VALUES %(values)s) AS v (key, pk, delta) ' \
+              'WHERE %(table)s.%(pk)s = v.pk AND %(table)s.%(key)s = v.key' % {
+                  'table': qn(opts.db_table),
+                  'column': column,
+                  'values': ', '.join(['(%s, %s, %s)'] * len(rows)),
+                  'pk': qn(opts.pk.column),
+                  'key': qn(key_field.column),
+              }
+        cursor = connection.cursor()
+        try:
+            cursor.execute(sql, [value for row in rows for value in row])
+        except Exception:
+            transaction.rollback_unless_managed(using=alias)
+            raise
+        transaction.commit_unless_managed(using=alias)
+
+
+class StripedCounter(object):
+    """
+    A counter spread over ``stripes`` rows, so concurrent increments of a hot
+    counter don't all wait on the same row lock.
+
+    Stripes are rows of the partitioned ``model``, which is partitioned like
+    the model being counted (and so places the stripes on the same partition
+    as the counted row), and needs the fields::
+
+        <shard key>, <field>, stripe, value
+
+    with ``unique_together`` on the shard key, ``field`` and ``stripe``.
+    Increments go to a random stripe, and reads sum the stripes, caching the
+    totals for ``cache_ttl`` seconds if given.
+
+    >>> votes = StripedCounter(ChoiceVoteStripe, 'choice_id')
+    >>> votes.incr(poll_id, choice_id)
+    >>> votes.get(poll_id, choice_id)
+    1
+    """
+    def __init__(self, model, field, stripes=8, cache_ttl=None):
+        shards = model._shards
+        assert len(shards.key) == 1, 'StripedCounter requires %s models to have a single shard key.' % (
+            model.__name__,)
+        self.model = model
+        self.key = shards.key[0]
+        self.field = field
+        self.stripes = stripes
+        self.cache_ttl = cache_ttl
+
+    def __repr__(self):
+        return u'<%s: model=%s, stripes=%s>' % (self.__class__.__name__, self.model.__name__, self.stripes)
+
+    def get_cache_key(self, key, pk):
+        return 'sqlshards:stripes:%s:%s:%s' % (self.model._meta.db_table, key, pk)
+
+    def incr(self, key, pk, delta=1):
+        """
+        Adds ``delta`` to a random stripe of the counter ``pk``.
+        """
+        lookup = {self.key: key, self.field: pk, 'stripe': random.randrange(self.stripes)}
+        queryset = self.model.objects.filter(**lookup)
+        if queryset.update(value=F('value') + delta):
+            return
+
+        # First increment of this stripe
+        using = self.model.objects.get_database_from_key(key)
+        sid = transaction.savepoint(using=using)
+        try:
+            self.model.objects.create(value=delta, **lookup)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid, using=using)
+            queryset.update(value=F('value') + delta)
+        else:
+            transaction.savepoint_commit(sid, using=using)
+
+    def get(self, key, pk):
+        """
+        Returns the value of the counter ``pk``.
+        """
+        return self.get_many(key, [pk])[pk]
+
+    def get_many(self, key, pks):
+        """
+        Returns a dictionary mapping each of ``pks`` (counters routed by
+        ``key``) to its value, in a single query.
+        """
+        pks = list(pks)
+        values = {}
+        if self.cache_ttl:
+            cached = cache.get_many([self.get_cache_key(key, pk) for pk in pks])
+            for pk in pks:
+                value = cached.get(self.get_cache_key(key, pk))
+                if value is not None:
+                    values[pk] = value
+
+        missing = [pk for pk in pks if pk not in values]
+        if missing:
+            rows = self.model.objects.filter(**{self.key: key, '%s__in' % self.field: missing}) \
+                .values_list(self.field).annotate(total=Sum('value'))
+            fetched = dict((pk, 0) for pk in missing)
+            fetched.update(rows)
+            if self.cache_ttl:
+                cache.set_many(dict((self.get_cache_key(key, pk), value) for pk, value in fetched.iteritems()),
+                               self.cache_ttl)
+            values.update(fetched)
+        return values
+
+    def write_partition(self, model, alias, rows):
+        """
+        Adds the ``(key, pk, delta)`` ``rows`` to random stripes in the
+        partition ``model`` on database ``alias``, creating stripes which
+        don't exist yet, in a single statement.
+        """
+        connection = connections[alias]
+        qn = connection.ops.quote_name
+        opts = model._meta
+        columns = {
+            'table': qn(opts.db_table),
+            'key': qn(opts.get_field(self.key).column),
+            'field': qn(opts.get_field(self.field).column),
+            'stripe': qn(opts.get_field('stripe').column),
+            'value': qn(opts.get_field('value').column),
+            'values': ', '.join(['(%s, %s, %s, %s)'] * len(rows)),
+        }
+
+        sql = 'WITH v (key, pk, stripe, delta) AS (VALUES %(values)s), ' \
+              'u AS (UPDATE %(table)s SET %(value)s = %(table)s.%(value)s + v.delta FROM v ' \
+              'WHERE %(table)s.%(key)s = v.key AND %(table)s.%(field)s = v.pk AND %(table)s.%(stripe)s = v.stripe ' \
+              'RETURNING %(table)s.%(key)s, %(table)s.%(field)s, %(table)s.%(stripe)s) ' \
+              'INSERT INTO %(table)s (%(key)s, %(field)s, %(stripe)s, %(value)s) ' \
+              'SELECT v.key, v.pk, v.stripe, v.delta FROM v WHERE NOT EXISTS (' \
+              'SELECT 1 FROM u WHERE u.%(key)s = v.key AND u.%(field)s = v.pk AND u.%(stripe)s = v.stripe)' % columns
+        params = []
+        for key, pk, delta in rows:
+            params.extend((key, pk, random.randrange(self.stripes), delta))
+
+        cursor = connection.cursor()
+        try:
+            cursor.execute(sql, params)
+        except Exception:
+            transaction.rollback_unless_managed(using=alias)
+            raise
+        transaction.commit_unless_managed(using=alias)
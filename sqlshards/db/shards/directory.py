@@ -0,0 +1,187 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from array import array
+
+from django.conf import settings
+from django.db import connections
+
+DEFAULT_NUM_BUCKETS = 4096
+
+
+class ShardDirectory(object):
+    """
+    Maps a fixed number of virtual buckets onto the physical shards (database
+    aliases) of a cluster.  A key belongs to bucket ``key % num_buckets``,
+    and a bucket belongs to partition ``bucket % num_shards``.
+
+    As ``num_buckets`` must be a multiple of ``num_shards``, the partition a
+    key is stored in never changes (keeping the CHECK constraints generated
+    by ``sqlpartition`` valid), but the host of each bucket can be moved
+    independently.  By default buckets are placed on
+    ``partition % size``, which is identical to routing by modulo.
+
+    Configured per cluster through the ``SHARD_DIRECTORY`` setting::
+
+        SHARD_DIRECTORY = {
+            'sharded': {
+                # number of virtual buckets
+                'buckets': 4096,
+                # number of physical shards the default placement spreads
+                # partitions over (defaults to the size of the cluster)
+                'size': 2,
+                # buckets which have been moved, as {bucket: shard}
+                'hosts': {17: 2},
+                # (optional) table with (bucket, host) rows of moved buckets,
+                # read from the cluster's connection on first use
+                'table': 'shard_directory',
+            },
+        }
+    """
+    def __init__(self, cluster, num_shards, size, num_buckets=DEFAULT_NUM_BUCKETS, hosts=None, table=None):
+        if num_buckets % num_shards:
+            raise ValueError('Number of buckets (%d) must be a multiple of the number of shards (%d) on %r' % (
+                num_buckets, num_shards, cluster))
+
+        self.cluster = cluster
+        self.num_shards = num_shards
+        self.num_buckets = num_buckets
+        self.size = size
+        self.table = table
+
+        # Aliases are looked up as ``aliases[slave][host]``
+        self.aliases = ((), ())
+
+        if size:
+            self.hosts = array('H', ((b % num_shards) % size for b in xrange(num_buckets)))
+            self.compile_aliases()
+            for bucket, host in (hosts or {}).iteritems():
+                self.assign(bucket, host)
+        else:
+            self.hosts = None
+        self.loaded = table is None
+
+    def compile_aliases(self):
+        num_hosts = max(self.hosts) + 1
+        self.aliases = (tuple(self.get_alias(h) for h in xrange(num_hosts)),
+                        tuple(self.get_alias(h, slave=True) for h in xrange(num_hosts)))
+
+    def __repr__(self):
+        return u'<%s: cluster=%s, num_shards=%s, num_buckets=%s>' % (
+            self.__class__.__name__, self.cluster, self.num_shards, self.num_buckets)
+
+    def get_alias(self, host, slave=False):
+        if host is None:
+            return
+        if slave:
+            return '%s.slave.shard%d' % (self.cluster, host)
+        return '%s.shard%d' % (self.cluster, host)
+
+    def get_bucket(self, key):
+        return key % self.num_buckets
+
+    def get_partition(self, key):
+        return key % self.num_shards
+
+    def get_host(self, key):
+        if not self.loaded:
+            self.load()
+        return self.hosts[key % self.num_buckets]
+
+    def get_database(self, key, slave=False):
+        """
+        Returns the database alias that ``key`` lives on.
+        """
+        if self.hosts is None:
+            return
+        if not self.loaded:
+            self.load()
+        return self.aliases[slave][self.hosts[key % self.num_buckets]]
+
+    def get_buckets(self, partition=None, host=None):
+        """
+        Returns the buckets stored in ``partition`` and/or on ``host``.
+        """
+        if host is not None and not self.loaded:
+            self.load()
+        return [b for b in xrange(self.num_buckets)
+                if (partition is None or b % self.num_shards == partition)
+                and (host is None or self.hosts[b] == host)]
+
+    def get_locations(self):
+        """
+        Returns a sorted list of all ``(partition, host)`` pairs holding data.
+        """
+        if self.hosts is None:
+            return [(p, None) for p in xrange(self.num_shards)]
+        if not self.loaded:
+            self.load()
+        return sorted(set((b % self.num_shards, host) for b, host in enumerate(self.hosts)))
+
+    def get_partition_databases(self, partition, slave=False):
+        """
+        Returns the database aliases which hold part of ``partition``.
+        """
+        return [self.get_alias(host, slave=slave)
+                for p, host in self.get_locations() if p == partition]
+
+    def assign(self, bucket, host):
+        """
+        Moves ``bucket`` to ``host``.
+        """
+        if not 0 <= bucket < self.num_buckets:
+            raise ValueError('Bucket %r does not exist on %r' % (bucket, self.cluster))
+        self.hosts[bucket] = host
+        if host >= len(self.aliases[0]):
+            self.compile_aliases()
+
+    def load(self, using=None):
+        """
+        Reads moved buckets from ``table``.
+        """
+        connection = connections[using or self.cluster]
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SELECT bucket, host FROM %s' % (connection.ops.quote_name(self.table),))
+            for bucket, host in cursor.fetchall():
+                self.assign(bucket, host)
+        finally:
+            cursor.close()
+        self.loaded = True
+
+
+_directories = {}
+
+
+def get_directory(cluster, num_shards, size):
+    """
+    Returns the ``ShardDirectory`` for ``cluster``.  Models sharing a cluster
+    and number of shards share a directory, so rows with the same key stay
+    on the same host.
+    """
+    try:
+        return _directories[(cluster, num_shards)]
+    except KeyError:
+        pass
+
+    config = getattr(settings, 'SHARD_DIRECTORY', {}).get(cluster, {})
+    num_buckets = config.get('buckets', num_shards * max(1, DEFAULT_NUM_BUCKETS // num_shards))
+    directory = ShardDirectory(cluster, num_shards, config.get('size', size),
+                               num_buckets=num_buckets,
+                               hosts=config.get('hosts'),
+                               table=config.get('table'))
+    _directories[(cluster, num_shards)] = directory
+    return directory
@@ -14,12 +14,91 @@
    limitations under the License.
 """
 
+import atexit
+import logging
+import os
+import threading
+import weakref
+from collections import deque
+
 from django.db import connections, transaction
 from django.db.models.fields import AutoField, BigIntegerField
-from django.db.models.signals import post_syncdb, class_prepared
+from django.db.models.signals import post_syncdb, class_prepared, pre_save
 from django.db.utils import DatabaseError
 from django.utils.translation import ugettext_lazy as _
 
+from sqlshards.db.shards.helpers import get_sharded_id_sequence_name
+from sqlshards.db.shards.ids import generator
+
+logger = logging.getLogger('sqlshards.sequences')
+
+_blocks = weakref.WeakSet()
+
+
+class SequenceBlock(object):
+    """
+    Hands out values of a PostgreSQL sequence from an in-process, thread-safe
+    cache, reserving ``size`` values per round trip to the database.
+
+    By default the block is reserved with ``generate_series``.  If
+    ``increment`` is True the sequence is expected to be created with
+    ``INCREMENT BY <size>``, and a single ``NEXTVAL`` reserves the block.
+    """
+    def __init__(self, size, increment=False, name=None):
+        self.size = size
+        self.increment = increment
+        self.name = name
+        self.blocks = 0
+        self.served = 0
+        self._values = deque()
+        self._lock = threading.Lock()
+        _blocks.add(self)
+
+    @property
+    def unused(self):
+        """
+        The number of reserved values which have not been handed out yet, and
+        would be wasted if the process exited now.
+        """
+        return len(self._values)
+
+    def get_stats(self):
+        return {
+            'blocks': self.blocks,
+            'served': self.served,
+            'unused': self.unused,
+        }
+
+    def next_value(self, db_alias, sequence):
+        with self._lock:
+            if not self._values:
+                self._values.extend(self.fetch(db_alias, sequence))
+                self.blocks += 1
+            self.served += 1
+            return self._values.popleft()
+
+    def fetch(self, db_alias, sequence):
+        cursor = connections[db_alias].cursor()
+        try:
+            if self.increment:
+                cursor.execute("SELECT NEXTVAL(%s)", (sequence,))
+                start = cursor.fetchone()[0]
+                return xrange(start, start + self.size)
+            cursor.execute("SELECT NEXTVAL(%s) FROM generate_series(1, %s)", (sequence, self.size))
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+
+def report_sequence_blocks():
+    for block in list(_blocks):
+        if not block.blocks:
+            continue
+        logger.info('Sequence %s used %d block(s) of %d, wasting %d value(s)',
+                    block.name, block.blocks, block.size, block.unused)
+
+atexit.register(report_sequence_blocks)
+
 
 class AutoSequenceField(BigIntegerField):
     """
@@ -32,6 +111,15 @@ class AutoSequenceField(BigIntegerField):
 
         ``sequence`` is the string representation of the sequence table.
 
+        ``block_size`` reserves that many values per round trip to the
+        database, handing them out from an in-process cache (see
+        ``SequenceBlock``).  Values left in the cache when the process exits
+        are never used.
+
+        ``increment_by_block`` creates the sequence with ``INCREMENT BY
+        <block_size>`` so a block is reserved with a single ``NEXTVAL``.  Every
+        user of the sequence must then allocate in blocks.
+
     """
 
     description = _("Integer")
@@ -39,6 +127,8 @@ class AutoSequenceField(BigIntegerField):
     def __init__(self, db_alias, sequence=None, *args, **kwargs):
         self.db_alias = db_alias
         self.sequence = sequence
+        self.block_size = kwargs.pop('block_size', 1)
+        self.increment_by_block = kwargs.pop('increment_by_block', False)
 
         kwargs['blank'] = True
         kwargs['editable'] = False
@@ -47,6 +137,8 @@ class AutoSequenceField(BigIntegerField):
 
     def set_sequence_name(self, **kwargs):
         self._sequence = self.sequence or '%s_%s_seq' % (self.model._meta.db_table, self.column)
+        if self.block_size > 1:
+            self._block = SequenceBlock(self.block_size, increment=self.increment_by_block, name=self._sequence)
 
     def create_sequence(self, created_models, **kwargs):
         if self.model not in created_models:
@@ -58,10 +150,15 @@ class AutoSequenceField(BigIntegerField):
         # if hasattr(self.model, '_shards') and hasattr(self.model._shards, 'parent') and self.model._shards.parent not in created_models:
         #     return
 
+        if self.increment_by_block:
+            sql = "CREATE SEQUENCE %s INCREMENT BY %d;" % (self._sequence, self.block_size)
+        else:
+            sql = "CREATE SEQUENCE %s;" % self._sequence
+
         cursor = connections[self.db_alias].cursor()
         sid = transaction.savepoint(self.db_alias)
         try:
-            cursor.execute("CREATE SEQUENCE %s;" % self._sequence)
+            cursor.execute(sql)
         except DatabaseError:
             transaction.savepoint_rollback(sid, using=self.db_alias)
             # Sequence must already exist, ensure it gets reset
@@ -92,6 +189,9 @@ class AutoSequenceField(BigIntegerField):
         return (field_class, args, kwargs)
 
     def get_next_value(self):
+        if self.block_size > 1:
+            return self._block.next_value(self.db_alias, self._sequence)
+
         cursor = connections[self.db_alias].cursor()
         try:
             cursor.execute("SELECT NEXTVAL(%s)", (self._sequence,))
@@ -101,6 +201,76 @@ class AutoSequenceField(BigIntegerField):
 
 
 class ShardedAutoField(AutoField):
+    """
+    An ``AutoField`` whose values are generated by ``next_sharded_id`` on each
+    child table.
+
+        ``client_side`` generates the id in Python instead (see
+        ``ShardedIDGenerator.next_worker_id``), assigning it before the row
+        is saved without a round trip to the database.  The sequence bits of
+        the id hold a worker slot and a per-millisecond counter.  Each process
+        takes a slot from the partition's sequence the first time it inserts,
+        round robin, so ids are unique as long as fewer than
+        ``2 ** worker_bits`` processes insert into a partition at once.  Rows
+        inserted through the column's default (``next_sharded_id``) could
+        collide with them, so every insert must go through the model.
+
+        ``worker_bits`` (1 to 9, defaults to 6) trades the number of slots
+        for the number of ids a process can generate per millisecond and
+        partition (``2 ** (10 - worker_bits)``) before borrowing from the
+        next millisecond.
+
+    """
+    def __init__(self, *args, **kwargs):
+        self.client_side = kwargs.pop('client_side', False)
+        self.worker_bits = kwargs.pop('worker_bits', 6)
+        super(ShardedAutoField, self).__init__(*args, **kwargs)
+
+    def contribute_to_class(self, cls, name):
+        super(ShardedAutoField, self).contribute_to_class(cls, name)
+        # Each partition's table is created by syncdb, and needs its sequence
+        post_syncdb.connect(self.create_sequence, dispatch_uid='create_sharded_sequence_%s_%s' % (cls._meta, name),
+                            weak=False)
+        if self.client_side:
+            # Fields are shallow copied onto each partition, so every
+            # partition takes a slot of its own.
+            self._worker = None
+            self._worker_lock = threading.Lock()
+            # Model.save() skips AutoFields when the pk isn't set, so the id
+            # must be assigned before it checks.
+            pre_save.connect(self.assign_id, sender=cls, weak=False)
+
+    def assign_id(self, instance, raw=False, **kwargs):
+        if not raw:
+            self.pre_save(instance, True)
+
+    def pre_save(self, model_instance, add):
+        value = getattr(model_instance, self.attname, None)
+        if add and value is None and self.client_side and model_instance._shards.is_child:
+            value = self.get_next_value()
+            setattr(model_instance, self.attname, value)
+        return value
+
+    def get_worker(self):
+        """
+        Returns this process's slot for the partition, taking one from the
+        partition's sequence on first use (and again after a fork).
+        """
+        pid = os.getpid()
+        with self._worker_lock:
+            if self._worker is None or self._worker[0] != pid:
+                alias = self.model._shards.get_database()
+                cursor = connections[alias].cursor()
+                try:
+                    cursor.execute("SELECT NEXTVAL(%s)", (get_sharded_id_sequence_name(self.model),))
+                    self._worker = (pid, cursor.fetchone()[0])
+                finally:
+                    cursor.close()
+            return self._worker[1]
+
+    def get_next_value(self):
+        return generator.next_worker_id(self.model._shards.num, self.get_worker(), self.worker_bits)
+
     def db_type(self, *args, **kwargs):
         if not hasattr(self.model, '_shards'):
             raise ValueError("ShardedAutoField must be used with a PartitionModel.")
@@ -112,26 +282,26 @@ class ShardedAutoField(AutoField):
             get_sharded_id_sequence_name(self.model),
             self.model._shards.num)
 
-    def create_sequence(self, created_models, **kwargs):
+    def create_sequence(self, created_models, db=None, **kwargs):
         # Sequence creation for production is handled by DDL scripts
         # (sqlpartition).  This is needed to create sequences for
         # test models.
-        if self.model not in created_models:
+        if self.model not in created_models or not self.model._shards.is_child:
             return
 
-        db_alias = self.model._shards.cluster
-
-        for child in self.model._shards.nodes:
-            cursor = connections[db_alias].cursor()
-            sid = transaction.savepoint(db_alias)
-            sequence_name = get_sharded_id_sequence_name(child)
-            try:
-                cursor.execute("CREATE SEQUENCE %s;" % sequence_name)
-            except DatabaseError:
-                transaction.savepoint_rollback(sid, using=db_alias)
-                # Sequence must already exist, ensure it gets reset
-                cursor.execute("SELECT setval('%s', 1, false)" % (sequence_name,))
-            else:
-                print 'Created sequence %r on %r' % (sequence_name, db_alias)
-                transaction.savepoint_commit(sid, using=db_alias)
-            cursor.close()
+        db_alias = db or self.model._shards.cluster
+        sequence_name = get_sharded_id_sequence_name(self.model)
+
+        cursor = connections[db_alias].cursor()
+        sid = transaction.savepoint(db_alias)
+        try:
+            cursor.execute("CREATE SEQUENCE %s;" % sequence_name)
+        except DatabaseError:
+            transaction.savepoint_rollback(sid, using=db_alias)
+            # Sequence must already exist, ensure it gets reset
+            cursor.execute("SELECT setval('%s', 1, false)" % (sequence_name,))
+        else:
+            print 'Created sequence %r on %r' % (sequence_name, db_alias)
+            transaction.savepoint_commit(sid, using=db_alias)
+        cursor.close()
+        transaction.commit_unless_managed(using=db_alias)
@@ -32,5 +32,19 @@ def get_canonical_model(model):
     return model
 
 
+def get_partitioned_model(app, model_name):
+    """
+    Returns the master partitioned model named ``model_name`` from the
+    ``app`` models module.  (get_model can't be used as they're abstract.)
+    """
+    for obj in (getattr(app, x) for x in dir(app)):
+        if not hasattr(obj, '_shards') or not obj._shards.is_master:
+            continue
+
+        if obj._meta.module_name == model_name:
+            return obj
+    raise ValueError('%r is not a partitioned model' % (model_name,))
+
+
 #: Returns ``True`` if the given class is a partitioned model.
 is_partitioned = lambda cls: hasattr(cls, '_shards')
@@ -0,0 +1,121 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+
+SEQUENCE_BITS = 10
+SHARD_BITS = 13
+TIMESTAMP_SHIFT = SHARD_BITS + SEQUENCE_BITS
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+MAX_SHARD = (1 << SHARD_BITS) - 1
+
+
+class ShardedIDGenerator(object):
+    """
+    Generates ids in Python using the same layout as the ``next_sharded_id``
+    PL/pgSQL function::
+
+        (milliseconds since SHARD_EPOCH) << 23 | shard << 10 | sequence % 1024
+
+    Ids are strictly increasing per shard within a process.  If the clock moves
+    backwards (or a sequence value would repeat within a millisecond), the
+    timestamp is held at (or advanced past) the last one used rather than
+    going back in time.
+    """
+    def __init__(self, epoch=None, clock=time.time):
+        self._epoch = epoch
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._last = {}
+        self._counts = {}
+
+    @property
+    def epoch(self):
+        if self._epoch is None:
+            return settings.SHARD_EPOCH
+        return self._epoch
+
+    def next_id(self, shard, sequence_value):
+        """
+        Returns the next id for ``shard``, given the next value of the
+        partition's sequence.
+
+        >>> generator.next_id(3, 8123)
+        """
+        if not 0 <= shard <= MAX_SHARD:
+            raise ValueError('Shard %r is out of range for a sharded id' % (shard,))
+
+        now = int(self.clock() * 1000)
+        seq = sequence_value & MAX_SEQUENCE
+
+        with self._lock:
+            last_millis, last_seq = self._last.get(shard, (-1, -1))
+            millis = max(now, last_millis)
+            if millis == last_millis and seq <= last_seq:
+                millis += 1
+            self._last[shard] = (millis, seq)
+
+        return ((millis - self.epoch) << TIMESTAMP_SHIFT) | (shard << SEQUENCE_BITS) | seq
+
+
+    def next_worker_id(self, shard, worker, worker_bits):
+        """
+        Returns the next id for ``shard`` without a sequence: the sequence
+        bits are split into ``worker`` (the low ``worker_bits`` bits of which
+        are used) and a counter of the ids this process generated for
+        ``shard`` in the current millisecond.  Once the counter is exhausted
+        the timestamp is advanced past the current millisecond.
+
+        >>> generator.next_worker_id(3, 17, 6)
+        """
+        if not 0 <= shard <= MAX_SHARD:
+            raise ValueError('Shard %r is out of range for a sharded id' % (shard,))
+        if not 0 < worker_bits < SEQUENCE_BITS:
+            raise ValueError('Worker bits must be between 1 and %d' % (SEQUENCE_BITS - 1,))
+
+        counter_bits = SEQUENCE_BITS - worker_bits
+        now = int(self.clock() * 1000)
+
+        with self._lock:
+            last_millis, last_count = self._counts.get(shard, (-1, -1))
+            millis = max(now, last_millis)
+            count = last_count + 1 if millis == last_millis else 0
+            if count >> counter_bits:
+                millis += 1
+                count = 0
+            self._counts[shard] = (millis, count)
+
+        worker &= (1 << worker_bits) - 1
+        return ((millis - self.epoch) << TIMESTAMP_SHIFT) | (shard << SEQUENCE_BITS) | \
+            (worker << counter_bits) | count
+
+
+def parse_sharded_id(value, epoch=None):
+    """
+    Splits a sharded id into ``(unix timestamp in milliseconds, shard, sequence)``.
+    """
+    if epoch is None:
+        epoch = settings.SHARD_EPOCH
+    return ((value >> TIMESTAMP_SHIFT) + epoch,
+            (value >> SEQUENCE_BITS) & MAX_SHARD,
+            value & MAX_SEQUENCE)
+
+
+#: Process wide generator used by ``ShardedAutoField(client_side=True)``.
+generator = ShardedIDGenerator()
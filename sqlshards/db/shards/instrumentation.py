@@ -0,0 +1,323 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import logging
+import re
+import socket
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.backends import BaseDatabaseWrapper
+from django.utils.importlib import import_module
+
+from sqlshards.db.shards.replicas import tracker
+
+#: Upper bounds (in seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+SHARD_ALIAS_EXPR = re.compile(r'.*\.shard\d+$')
+TABLE_EXPR = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+"?(\w+)"?', re.IGNORECASE)
+
+#: Where ``CacheSink`` stores the stats of every process.
+CACHE_KEY = 'sqlshards:queries'
+
+logger = logging.getLogger('sqlshards.queries')
+
+_sink = None
+_original_cursor = None
+
+
+class QueryStats(object):
+    """
+    Query count, errors, rows and a latency histogram for one alias and table.
+    """
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.time = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, seconds, rows, error):
+        self.count += 1
+        self.time += seconds
+        if error:
+            self.errors += 1
+        if rows > 0:
+            self.rows += rows
+        self.histogram[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.errors += other.errors
+        self.rows += other.rows
+        self.time += other.time
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+
+    def get_percentile(self, percentile):
+        """
+        Returns the upper bound of the histogram bucket the given percentile
+        (0-100) of queries falls in, or None for the overflow bucket.
+        """
+        threshold = self.count * percentile / 100.0
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (None,), self.histogram):
+            seen += count
+            if seen >= threshold:
+                return bound
+        return None
+
+
+class MemorySink(object):
+    """
+    Aggregates query stats in memory, keyed by ``(alias, table)``.
+    """
+    def __init__(self):
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, alias, table, seconds, rows, error):
+        with self._lock:
+            self._add(alias, table, seconds, rows, error)
+
+    def _add(self, alias, table, seconds, rows, error):
+        # Callers must hold ``self._lock``
+        try:
+            stats = self.stats[(alias, table)]
+        except KeyError:
+            stats = self.stats[(alias, table)] = QueryStats()
+        stats.add(seconds, rows, error)
+
+    def get_table_stats(self):
+        """
+        Returns a copy of the stats per ``(alias, table)``.
+        """
+        result = {}
+        with self._lock:
+            for key, stats in self.stats.iteritems():
+                result[key] = copy = QueryStats()
+                copy.merge(stats)
+        return result
+
+    def get_alias_stats(self):
+        """
+        Returns stats combined per alias.
+        """
+        return combine_by_alias(self.get_table_stats())
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+
+
+class CacheSink(MemorySink):
+    """
+    Aggregates query stats in memory, and merges them per ``(alias, table)``
+    into the cache every ``flush_every`` queries, for ``manage.py hotshards``
+    to report across processes.  Concurrent merges may lose some queries.
+    """
+    def __init__(self, flush_every=1000, timeout=86400):
+        super(CacheSink, self).__init__()
+        self.flush_every = flush_every
+        self.timeout = timeout
+        self.pending = 0
+
+    def record(self, alias, table, seconds, rows, error):
+        with self._lock:
+            self._add(alias, table, seconds, rows, error)
+            self.pending += 1
+            flush = self.pending >= self.flush_every
+            if flush:
+                # Only the thread that reached the threshold flushes
+                self.pending = 0
+        if flush:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            stats, self.stats = self.stats, {}
+            self.pending = 0
+        if not stats:
+            return
+        totals = cache.get(CACHE_KEY) or {}
+        for key, table_stats in stats.iteritems():
+            totals.setdefault(key, QueryStats()).merge(table_stats)
+        cache.set(CACHE_KEY, totals, self.timeout)
+
+
+def combine_by_alias(stats):
+    """
+    Combines stats keyed by ``(alias, table)`` into stats per alias.
+    """
+    result = {}
+    for (alias, table), table_stats in stats.iteritems():
+        result.setdefault(alias, QueryStats()).merge(table_stats)
+    return result
+
+
+def get_recorded_stats():
+    """
+    Returns the query stats per ``(alias, table)`` recorded so far: those
+    flushed to the cache by ``CacheSink``, plus those held by this process'
+    sink.
+    """
+    totals = cache.get(CACHE_KEY) or {}
+    if isinstance(_sink, MemorySink):
+        for key, stats in _sink.get_table_stats().iteritems():
+            totals.setdefault(key, QueryStats()).merge(stats)
+    return totals
+
+
+class LoggingSink(object):
+    """
+    Logs every query to the ``sqlshards.queries`` logger.
+    """
+    def __init__(self, level=logging.DEBUG):
+        self.level = level
+
+    def record(self, alias, table, seconds, rows, error):
+        logger.log(self.level, '%s %s %.2fms rows=%d error=%s', alias, table, seconds * 1000, rows, error)
+
+
+class StatsdSink(object):
+    """
+    Sends counters and timers to a statsd server over UDP, as
+    ``<prefix>.<alias>.<table>.(queries|errors|rows|time)``.
+    """
+    def __init__(self, host='localhost', port=8125, prefix='sqlshards'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, alias, table, seconds, rows, error):
+        name = '%s.%s.%s' % (self.prefix, alias.replace('.', '_'), table)
+        lines = ['%s.queries:1|c' % name, '%s.time:%.3f|ms' % (name, seconds * 1000)]
+        if rows > 0:
+            lines.append('%s.rows:%d|c' % (name, rows))
+        if error:
+            lines.append('%s.errors:1|c' % name)
+        try:
+            self.socket.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            pass
+
+
+def get_sink():
+    return _sink
+
+
+def record(alias, sql, seconds, rows, error):
+    sink = _sink
+    if sink is None:
+        return
+    match = TABLE_EXPR.search(sql)
+    table = match.group(1) if match else None
+    sink.record(alias, table, seconds, rows, error)
+    # Feed query latencies into replica selection
+    if '.slave' in alias:
+        tracker.record(alias, seconds)
+
+
+class InstrumentedCursor(object):
+    """
+    Wraps a cursor, recording the latency, row count and outcome of each
+    query executed through it.
+    """
+    def __init__(self, cursor, alias):
+        self.cursor = cursor
+        self.alias = alias
+
+    def _measure(self, method, sql, params):
+        start = time.time()
+        try:
+            result = method(sql, params)
+        except Exception:
+            record(self.alias, sql, time.time() - start, 0, True)
+            raise
+        record(self.alias, sql, time.time() - start, self.cursor.rowcount, False)
+        return result
+
+    def execute(self, sql, params=()):
+        return self._measure(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._measure(self.cursor.executemany, sql, param_list)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def instrumented_cursor(self):
+    """
+    Replaces ``BaseDatabaseWrapper.cursor`` while instrumentation is
+    installed, wrapping the cursors of shard aliases.  Patching ``cursor()``
+    (rather than listening to ``connection_created``) covers every cursor of
+    every alias, including aliases sharing a multiplexed connection.
+    """
+    cursor = _original_cursor(self)
+    if _sink is not None and SHARD_ALIAS_EXPR.match(self.alias):
+        cursor = InstrumentedCursor(cursor, self.alias)
+    return cursor
+
+
+def install(sink):
+    """
+    Starts recording queries on shard connections to ``sink`` (an object with
+    a ``record(alias, table, seconds, rows, error)`` method).
+    """
+    global _sink, _original_cursor
+    _sink = sink
+    if _original_cursor is None:
+        _original_cursor = BaseDatabaseWrapper.cursor.im_func
+        BaseDatabaseWrapper.cursor = instrumented_cursor
+
+
+def uninstall():
+    """
+    Stops recording queries.
+    """
+    global _sink, _original_cursor
+    if isinstance(_sink, CacheSink):
+        _sink.flush()
+    _sink = None
+    if _original_cursor is not None:
+        BaseDatabaseWrapper.cursor = _original_cursor
+        _original_cursor = None
+
+
+def install_from_settings():
+    """
+    Installs the sink configured in ``SHARD_INSTRUMENTATION``, e.g.::
+
+        SHARD_INSTRUMENTATION = {
+            'sink': 'sqlshards.db.shards.instrumentation.StatsdSink',
+            'options': {'host': 'statsd.local'},
+        }
+
+    When unset, nothing is installed and queries aren't instrumented at all.
+    """
+    config = getattr(settings, 'SHARD_INSTRUMENTATION', None)
+    if not config:
+        return
+    module_name, class_name = config['sink'].rsplit('.', 1)
+    sink_class = getattr(import_module(module_name), class_name)
+    install(sink_class(**config.get('options', {})))
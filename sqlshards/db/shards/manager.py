@@ -14,9 +14,21 @@
    limitations under the License.
 """
 
-from django.db import transaction, router, IntegrityError
+import operator
+from heapq import heapify, heappop, heapreplace
+from itertools import chain, islice
+
+from django.db import connections, transaction, router, IntegrityError
+from django.db.models import Count, Q, Sum
+from django.db.models.fields import AutoField, FieldDoesNotExist
 from django.db.models.manager import Manager
 from django.db.models.query import QuerySet, ValuesQuerySet, ValuesListQuerySet
+from django.utils.datastructures import SortedDict
+
+from sqlshards.db.shards.helpers import get_canonical_model, is_partitioned
+from sqlshards.db.shards.objectcache import object_cache
+from sqlshards.db.shards.pool import GatheredResult, run_parallel, submit
+from sqlshards.db.shards.skew import sampler
 
 
 class PartitionQuerySetBase(object):
@@ -44,6 +56,8 @@ class PartitionQuerySet(PartitionQuerySetBase, QuerySet):
         super(PartitionQuerySet, self).__init__(model=model, *args, **kwargs)
         self.actual_model = actual_model or model
         self._exact_lookups = {}
+        self._prefetch_partitioned = ()
+        self._select_partitioned = ()
 
     def __getitem__(self, *args, **kwargs):
         try:
@@ -60,8 +74,153 @@ class PartitionQuerySet(PartitionQuerySetBase, QuerySet):
             klass = PartitionValuesListQuerySet
         clone = super(PartitionQuerySet, self)._clone(klass, *args, **kwargs)
         clone._exact_lookups = self._exact_lookups.copy()
+        clone._prefetch_partitioned = self._prefetch_partitioned
+        clone._select_partitioned = self._select_partitioned
+        return clone
+
+    def iterator(self):
+        objs = super(PartitionQuerySet, self).iterator()
+        if self._select_partitioned:
+            objs = self._attach_selected(objs)
+        if self._prefetch_partitioned:
+            objs = list(objs)
+            prefetch_partitioned(objs, *self._prefetch_partitioned)
+            return iter(objs)
+        return objs
+
+    def select_related(self, *fields, **kwargs):
+        """
+        Like ``QuerySet.select_related``, but ``PartitionedForeignKey`` fields
+        named in ``fields`` are joined against the matching partition of the
+        related model (e.g. ``choice_1`` with ``poll_1``), which lives on the
+        same database.
+
+        The join is an inner join, so rows whose related row is missing are
+        left out.
+        """
+        opts = self.model._meta
+        partitioned = []
+        for name in fields:
+            try:
+                field = opts.get_field(name)
+            except FieldDoesNotExist:
+                continue
+            if field.rel and is_partitioned(field.rel.to):
+                partitioned.append(field)
+
+        others = [name for name in fields if name not in set(f.name for f in partitioned)]
+        if partitioned and not others:
+            clone = self._clone()
+        else:
+            clone = super(PartitionQuerySet, self).select_related(*others, **kwargs)
+
+        for field in partitioned:
+            clone = clone._select_partitioned_field(field)
         return clone
 
+    def _select_partitioned_field(self, field):
+        shards = self.model._shards
+        rel_shards = field.rel.to._shards
+        assert shards.is_child, 'select_related() on %s requires a partition.' % (self.model.__name__,)
+
+        if field.null:
+            raise ValueError('Cannot select_related() nullable partitioned foreign key %r.' % (field.name,))
+        if field.rel.to is shards.parent:
+            raise ValueError('Cannot select_related() partitioned foreign key %r to the same model.' % (field.name,))
+        if rel_shards.num_shards != shards.num_shards or rel_shards.cluster != shards.cluster:
+            raise ValueError('Cannot select_related() %r as %s and %s are partitioned differently.' % (
+                field.name, shards.parent.__name__, field.rel.to.__name__))
+
+        rel_model = rel_shards.partition_models[shards.num]
+        qn = connections[self.db].ops.quote_name
+        rel_table = qn(rel_model._meta.db_table)
+
+        select = SortedDict(('_%s__%s' % (field.name, f.attname), '%s.%s' % (rel_table, qn(f.column)))
+                            for f in rel_model._meta.fields)
+        where = '%s.%s = %s.%s' % (qn(self.model._meta.db_table), qn(field.column),
+                                   rel_table, qn(field.rel.get_related_field().column))
+
+        clone = self.extra(select=select, tables=[rel_model._meta.db_table], where=[where])
+        clone._select_partitioned = self._select_partitioned + ((field, rel_model, tuple(select)),)
+        return clone
+
+    def _attach_selected(self, objs):
+        """
+        Builds the related objects joined in by ``select_related`` from the
+        extra columns of each result.
+        """
+        for obj in objs:
+            for field, rel_model, names in self._select_partitioned:
+                rel_obj = rel_model(*[obj.__dict__.pop(name) for name in names])
+                rel_obj._state.db = obj._state.db
+                rel_obj._state.adding = False
+                setattr(obj, field.get_cache_name(), rel_obj)
+            yield obj
+
+    def prefetch_partitioned(self, *field_names):
+        """
+        Fetches the objects referenced by the ``PartitionedForeignKey`` fields
+        named ``field_names`` for every result at once, see
+        ``prefetch_partitioned``.
+
+        >>> Vote.objects.filter(poll_id=1).prefetch_partitioned('choice')
+        """
+        clone = self._clone()
+        clone._prefetch_partitioned = self._prefetch_partitioned + field_names
+        return clone
+
+    def get(self, *args, **kwargs):
+        """
+        If the partitioned model sets ``cache_ttl`` in its ``Shards`` options,
+        lookups of a single row by shard key and primary key are read through
+        the object cache (see ``sqlshards.db.shards.objectcache``).
+        """
+        master = get_canonical_model(self.model)
+        lookup = self._get_cache_lookup(master, args, kwargs)
+        try:
+            if lookup is None:
+                return super(PartitionQuerySet, self).get(*args, **kwargs)
+
+            key, pk = lookup
+            using = self._db or router.db_for_read(self.model, exact_lookups=kwargs)
+            obj = object_cache.load(master, key, pk, using)
+            if obj is None:
+                obj = super(PartitionQuerySet, self).get(**kwargs)
+                object_cache.store(master, key, obj)
+            return obj
+        except self.model.DoesNotExist, e:
+            raise self.actual_model.DoesNotExist(unicode(e).replace(self.model.__name__, self.actual_model.__name__))
+
+    def _get_cache_lookup(self, master, args, kwargs):
+        """
+        Returns ``(shard key, pk)`` if ``get(*args, **kwargs)`` can be served
+        from the object cache, otherwise ``None``.
+        """
+        shards = master._shards
+        if not getattr(shards, 'cache_ttl', None) or args or self._for_write:
+            return None
+
+        query = self.query
+        if (query.where.children or query.select_related or query.extra or query.deferred_loading[0]
+                or query.select_for_update or query.low_mark or query.high_mark is not None):
+            return None
+
+        pk_field = self.model._meta.pk
+        pk_names = ('pk', 'pk__exact', pk_field.name, pk_field.name + '__exact', pk_field.attname)
+        pk = None
+        key_kwargs = {}
+        for name, value in kwargs.iteritems():
+            if name in shards.key:
+                key_kwargs[name] = value
+            elif name in pk_names and pk is None:
+                pk = value
+            else:
+                return None
+
+        if pk is None or len(key_kwargs) != len(shards.key):
+            return None
+        return shards.get_key_from_kwargs(**key_kwargs), pk_field.to_python(pk)
+
     def _filter_or_exclude(self, *args, **kwargs):
         clone = super(PartitionQuerySet, self)._filter_or_exclude(*args, **kwargs)
         if getattr(clone, '_exact_lookups', None) is None:
@@ -82,11 +241,80 @@ class PartitionQuerySet(PartitionQuerySetBase, QuerySet):
         obj.save(force_insert=True, using=self.db)
         return obj
 
-    def get(self, *args, **kwargs):
+    def bulk_create(self, objs, batch_size=None):
+        """
+        Inserts ``objs`` into this partition using multi-row INSERTs.  Unlike
+        QuerySet.bulk_create, the ids generated by the database (e.g. through
+        ``next_sharded_id``) are fetched with RETURNING and set on each object.
+
+        As with QuerySet.bulk_create, no signals are sent.
+        """
+        objs = list(objs)
+        if not objs:
+            return objs
+
+        self._for_write = True
+        using = self.db
+        connection = connections[using]
+        opts = self.model._meta
+
+        # Give fields generating their own ids (ShardedAutoField(client_side=True))
+        # a chance to assign them.
+        for obj in objs:
+            if obj.pk is None:
+                opts.pk.pre_save(obj, True)
+
+        objs_with_pk = [o for o in objs if o.pk is not None]
+        objs_without_pk = [o for o in objs if o.pk is None]
+
+        if not transaction.is_managed(using=using):
+            transaction.enter_transaction_management(using=using)
+            forced_managed = True
+        else:
+            forced_managed = False
         try:
-            return super(PartitionQuerySet, self).get(*args, **kwargs)
-        except self.model.DoesNotExist, e:
-            raise self.actual_model.DoesNotExist(unicode(e).replace(self.model.__name__, self.actual_model.__name__))
+            if objs_with_pk:
+                self._batched_insert(objs_with_pk, opts.local_fields, batch_size, connection)
+            if objs_without_pk:
+                fields = [f for f in opts.local_fields if not isinstance(f, AutoField)]
+                self._batched_insert(objs_without_pk, fields, batch_size, connection, return_id=True)
+            if forced_managed:
+                transaction.commit(using=using)
+            else:
+                transaction.commit_unless_managed(using=using)
+        finally:
+            if forced_managed:
+                transaction.leave_transaction_management(using=using)
+
+        for obj in objs:
+            obj._state.db = using
+            obj._state.adding = False
+        return objs
+
+    def _batched_insert(self, objs, fields, batch_size, connection, return_id=False):
+        batch_size = batch_size or len(objs)
+        for start in xrange(0, len(objs), batch_size):
+            self._insert_rows(objs[start:start + batch_size], fields, connection, return_id)
+
+    def _insert_rows(self, objs, fields, connection, return_id):
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+
+        row = '(%s)' % ', '.join(['%s'] * len(fields))
+        sql = 'INSERT INTO %s (%s) VALUES %s' % (
+            qn(opts.db_table),
+            ', '.join(qn(f.column) for f in fields),
+            ', '.join([row] * len(objs)))
+        params = [f.get_db_prep_save(f.pre_save(obj, True), connection=connection)
+                  for obj in objs for f in fields]
+        if return_id:
+            sql += ' RETURNING %s' % qn(opts.pk.column)
+
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        if return_id:
+            for obj, result in zip(objs, cursor.fetchall()):
+                setattr(obj, opts.pk.attname, result[0])
 
     def get_or_create(self, **kwargs):
         """
@@ -133,6 +361,332 @@ PartitionValuesQuerySet = partition_query_set_factory(ValuesQuerySet)
 PartitionValuesListQuerySet = partition_query_set_factory(ValuesListQuerySet)
 
 
+class Descending(object):
+    """
+    Wraps a value so that it sorts in reverse.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def merge_ordered(iterables, key):
+    """
+    Lazily merges ``iterables``, which must each already be sorted by
+    ``key``, into a single sorted iterator (a k-way merge using a heap).
+    """
+    heap = []
+    for index, iterable in enumerate(iter(i) for i in iterables):
+        for obj in iterable:
+            heap.append((key(obj), index, obj, iterable))
+            break
+    heapify(heap)
+
+    while heap:
+        _, index, obj, iterable = heap[0]
+        yield obj
+        for obj in iterable:
+            heapreplace(heap, (key(obj), index, obj, iterable))
+            break
+        else:
+            heappop(heap)
+
+
+def prefetch_partitioned(instances, *field_names):
+    """
+    Fills the cache of the ``PartitionedForeignKey`` fields named
+    ``field_names`` on ``instances``, which would otherwise be fetched with
+    a query per instance on first access.
+
+    The referenced ids are grouped by the partition their shard key routes
+    to, and each partition is queried once (with ``IN``), in parallel.
+
+    >>> votes = list(Vote.objects.filter(poll_id=1))
+    >>> prefetch_partitioned(votes, 'choice')
+    """
+    instances = [obj for obj in instances if obj is not None]
+    if not instances:
+        return instances
+
+    opts = instances[0]._meta
+    for name in field_names:
+        field = opts.get_field(name)
+        cache_name = field.get_cache_name()
+        rel_model = field.rel.to
+        relname = field.rel.field_name
+        rel_manager = rel_model._default_manager
+
+        groups = {}
+        pending = []
+        for obj in instances:
+            value = getattr(obj, field.attname)
+            if value is None or hasattr(obj, cache_name):
+                continue
+            key = obj._shards.get_key_from_instance(obj)
+            location = (rel_manager.get_model_from_key(key), rel_manager.get_database_from_key(key))
+            groups.setdefault(location, set()).add(value)
+            pending.append((obj, key, value))
+
+        if not groups:
+            continue
+
+        querysets = [
+            PartitionQuerySet(model=model, actual_model=rel_model).using(alias) \
+                .filter(**{'%s__in' % relname: sorted(values)})
+            for (model, alias), values in groups.iteritems()
+        ]
+
+        related = {}
+        for rows in ScatterQuerySet(rel_model, querysets)._execute(list):
+            for rel_obj in rows:
+                related[(rel_obj._shards.get_key_from_instance(rel_obj), getattr(rel_obj, relname))] = rel_obj
+
+        for obj, key, value in pending:
+            try:
+                setattr(obj, cache_name, related[(key, value)])
+            except KeyError:
+                # Leave missing rows for the descriptor to raise DoesNotExist
+                pass
+    return instances
+
+
+class ScatterQuerySet(object):
+    """
+    Fans a query out to every partition of a partitioned model.
+
+    Chainable methods (``filter``, ``exclude``, ``order_by``, etc.) are applied
+    to each partition's ``PartitionQuerySet``, and evaluation runs the
+    partition queries in parallel (see ``run_parallel``), chaining the results
+    together in partition order.
+
+    Once ordered with ``order_by``, results are merged across partitions in
+    order, and slicing pushes ``LIMIT <offset + limit>`` down to every
+    partition:
+
+    >>> Choice.objects.all_shards().order_by('-id')[20:40]
+
+    For deep pages use ``after`` (keyset pagination) rather than an offset:
+
+    >>> Choice.objects.all_shards().order_by('-id').after(last_id)[:20]
+    """
+    def __init__(self, model, querysets, ordering=(), prefetch=()):
+        self.model = model
+        self.querysets = querysets
+        self.ordering = tuple(ordering)
+        self.prefetch = tuple(prefetch)
+        self._result_cache = None
+
+    def __repr__(self):
+        return u'<%s: model=%s, partitions=%s>' % (
+            self.__class__.__name__, self.model.__name__, len(self.querysets))
+
+    def __iter__(self):
+        if self._result_cache is None:
+            self._result_cache = list(self.iterator())
+        return iter(self._result_cache)
+
+    def __len__(self):
+        return len(list(self.__iter__()))
+
+    def __getitem__(self, k):
+        if self._result_cache is not None:
+            return self._result_cache[k]
+
+        if not isinstance(k, slice):
+            try:
+                return list(self[k:k + 1])[0]
+            except IndexError:
+                raise IndexError('list index out of range')
+
+        assert k.step is None, 'Stepped slicing is not supported on %s.' % self.__class__.__name__
+        assert (k.start or 0) >= 0 and (k.stop is None or k.stop >= 0), 'Negative indexing is not supported.'
+        offset = k.start or 0
+
+        if k.stop is None:
+            return list(islice(self.iterator(), offset, None))
+
+        if not self.ordering:
+            # Without an ordering any rows will do, so take them in partition order
+            return list(islice(self.iterator(), offset, k.stop))
+
+        clone = self._clone([qs[:k.stop] for qs in self.querysets])
+        return list(islice(clone.iterator(), offset, k.stop))
+
+    def _clone(self, querysets=None, **kwargs):
+        if querysets is None:
+            querysets = [qs._clone() for qs in self.querysets]
+        kwargs.setdefault('ordering', self.ordering)
+        kwargs.setdefault('prefetch', self.prefetch)
+        return self.__class__(self.model, querysets, **kwargs)
+
+    def _execute(self, func):
+        """
+        Calls ``func(queryset)`` for every partition in parallel, returning
+        the results in partition order.
+        """
+        return run_parallel((qs.db, func, (qs,)) for qs in self.querysets)
+
+    def get_ordering_key(self):
+        """
+        Returns a function mapping a result (an instance, dict or tuple) to the
+        value it is sorted by.
+        """
+        ordering = [(name.lstrip('-'), name.startswith('-')) for name in self.ordering]
+        for name, descending in ordering:
+            if name == '?' or '__' in name:
+                raise ValueError('Ordering by %r is not supported across partitions.' % (name,))
+
+        fields = getattr(self.querysets[0], '_fields', None) if self.querysets else None
+        flat = getattr(self.querysets[0], 'flat', False) if self.querysets else False
+
+        def get_value(obj, name):
+            if flat:
+                return obj
+            if isinstance(obj, dict):
+                return obj[name]
+            if isinstance(obj, tuple):
+                try:
+                    return obj[list(fields).index(name)]
+                except ValueError:
+                    raise ValueError('Ordering field %r must be included in values_list().' % (name,))
+            return getattr(obj, name)
+
+        def key(obj):
+            return tuple(Descending(get_value(obj, name)) if descending else get_value(obj, name)
+                         for name, descending in ordering)
+        return key
+
+    def _combine(self, results):
+        if self.ordering:
+            results = merge_ordered(results, self.get_ordering_key())
+        else:
+            results = chain.from_iterable(results)
+        if self.prefetch:
+            # Prefetch for all partitions' rows together
+            results = list(results)
+            prefetch_partitioned(results, *self.prefetch)
+        return results
+
+    def iterator(self):
+        return self._combine(self._execute(list))
+
+    def submit(self):
+        """
+        Starts running the query on every partition in the background (see
+        ``pool.submit``), returning a result whose ``get()`` waits for all of
+        them and returns the combined list of rows.
+
+        >>> result = Choice.objects.all_shards().filter(votes__gt=10).submit()
+        >>> rows = result.get()
+        """
+        return GatheredResult([submit(qs.db, list, qs) for qs in self.querysets],
+                              lambda results: list(self._combine(results)))
+
+    def prefetch_partitioned(self, *field_names):
+        """
+        Fetches the objects referenced by the ``PartitionedForeignKey`` fields
+        named ``field_names`` for the rows of every partition at once, see
+        ``prefetch_partitioned``.
+        """
+        return self._clone(prefetch=self.prefetch + field_names)
+
+    def count(self):
+        if self._result_cache is not None:
+            return len(self._result_cache)
+        return sum(self._execute(lambda qs: qs.count()))
+
+    def aggregate(self, *args, **kwargs):
+        """
+        Computes ``Sum``, ``Count``, ``Min``, ``Max`` and ``Avg`` aggregates
+        across partitions.  Each partition computes partial aggregates (the sum
+        and count, for averages), in parallel, which are then combined.
+
+        >>> Choice.objects.all_shards().aggregate(Avg('votes'), total=Sum('votes'))
+        """
+        for arg in args:
+            kwargs[arg.default_alias] = arg
+
+        partials = {}
+        for alias, aggregate in kwargs.iteritems():
+            if aggregate.extra.get('distinct'):
+                raise ValueError('Distinct aggregates cannot be combined across partitions.')
+            if aggregate.name in ('Sum', 'Count', 'Min', 'Max'):
+                partials[alias] = aggregate
+            elif aggregate.name == 'Avg':
+                partials[alias + '__sum'] = Sum(aggregate.lookup)
+                partials[alias + '__count'] = Count(aggregate.lookup)
+            else:
+                raise ValueError('%s cannot be combined across partitions.' % (aggregate.name,))
+
+        results = self._execute(lambda qs: qs.aggregate(**partials))
+
+        def values(alias):
+            return [r[alias] for r in results if r[alias] is not None]
+
+        merged = {}
+        for alias, aggregate in kwargs.iteritems():
+            if aggregate.name == 'Count':
+                merged[alias] = sum(values(alias))
+            elif aggregate.name == 'Sum':
+                merged[alias] = sum(values(alias)) if values(alias) else None
+            elif aggregate.name == 'Min':
+                merged[alias] = min(values(alias)) if values(alias) else None
+            elif aggregate.name == 'Max':
+                merged[alias] = max(values(alias)) if values(alias) else None
+            else:
+                count = sum(values(alias + '__count'))
+                merged[alias] = float(sum(values(alias + '__sum'))) / count if count else None
+        return merged
+
+    def order_by(self, *field_names):
+        return self._clone([qs.order_by(*field_names) for qs in self.querysets], ordering=field_names)
+
+    def after(self, *values):
+        """
+        Filters to the rows which sort after ``values`` (one value for each
+        field in the ordering), for keyset pagination.
+        """
+        if not self.ordering:
+            raise ValueError('after() requires an ordering.')
+        if len(values) != len(self.ordering):
+            raise ValueError('after() expects a value for each of %r.' % (self.ordering,))
+
+        conditions = []
+        for index, name in enumerate(self.ordering):
+            lookups = dict((n.lstrip('-'), v) for n, v in zip(self.ordering[:index], values[:index]))
+            lookups['%s__%s' % (name.lstrip('-'), 'lt' if name.startswith('-') else 'gt')] = values[index]
+            conditions.append(Q(**lookups))
+        return self.filter(reduce(operator.or_, conditions))
+
+    def _proxy(method_name):
+        def wrapped(self, *args, **kwargs):
+            return self._clone([getattr(qs, method_name)(*args, **kwargs) for qs in self.querysets])
+
+        wrapped.__name__ = method_name
+        return wrapped
+
+    all = _proxy('all')
+    filter = _proxy('filter')
+    exclude = _proxy('exclude')
+    distinct = _proxy('distinct')
+    extra = _proxy('extra')
+    only = _proxy('only')
+    defer = _proxy('defer')
+    select_related = _proxy('select_related')
+    values = _proxy('values')
+    values_list = _proxy('values_list')
+
+
 class PartitionManager(Manager):
     def get_query_set(self):
         return PartitionQuerySet(model=self.model)
@@ -151,9 +705,36 @@ class MasterPartitionManager(Manager):
 
         >>> shard(343, slave=True)
         """
+        if sampler.rate:
+            sampler.sample(self.model, key)
         queryset = self.get_query_set(key)
         return queryset.using(self.get_database_from_key(key, slave=slave))
 
+    def all_shards(self, slave=False):
+        """
+        Returns a ``ScatterQuerySet`` spanning every partition, each bound to
+        the database its partition lives on.
+
+        >>> all_shards().filter(votes__gt=10)
+
+        >>> all_shards(slave=True)
+        """
+        shards = self.model._shards
+        directory = shards.directory
+        return ScatterQuerySet(self.model, [
+            PartitionQuerySet(model=shards.nodes[partition], actual_model=self.model) \
+                .using(directory.get_alias(host, slave=slave))
+            for partition, host in directory.get_locations()
+        ])
+
+    def scatter(self, *args, **kwargs):
+        """
+        Runs the given filter against every partition in parallel.
+
+        >>> scatter(votes__gt=10)
+        """
+        return self.all_shards().filter(*args, **kwargs)
+
     def get_database(self, shard, slave=False):
         """
         Given a shard (numeric index value), returns the correct database alias to query against.
@@ -161,17 +742,16 @@ class MasterPartitionManager(Manager):
         If ``slave`` is True, returns a read-slave.
         """
         try:
-            model = self.model._shards.nodes[shard]
+            return self.model._shards.partition_databases[shard][slave]
         except IndexError:
             raise ValueError('Shard %r does not exist on %r' % (shard, self.model.__name__))
-        return model._shards.get_database(slave=slave)
 
     def get_database_from_key(self, key, slave=False):
         """
         Given a key, which is defined by the partition and used to route queries, returns the
         database connection alias which the data lives on.
         """
-        return self.get_database(key % self.model._shards.num_shards, slave=slave)
+        return self.model._shards.directory.get_database(key, slave=slave)
 
     def get_model_from_key(self, key):
         """
@@ -179,7 +759,167 @@ class MasterPartitionManager(Manager):
         Model which represents the shard.
         """
         shards = self.model._shards
-        return shards.nodes[key % shards.num_shards]
+        # Same as shards.directory.get_partition(key), inlined as it's used
+        # to route every query
+        return shards.partition_models[key % shards.num_shards]
+
+    def get_many(self, keys, **kwargs):
+        """
+        Fetches the rows for many keys at once, issuing a single ``IN`` query
+        per partition and querying the partitions in parallel.  Any additional
+        ``kwargs`` are applied as filters.
+
+        Returns a dictionary mapping each key to a list of matching objects.
+
+        >>> get_many(keys=[1, 2, 3], votes__gt=0)
+        {1: [<Choice_Partition1: ...>], 2: [], 3: [...]}
+        """
+        shards = self.model._shards
+        assert len(shards.key) == 1, 'get_many() requires %s models to have a single shard key.' % (
+            self.model.__name__,)
+        field_name = shards.key[0]
+
+        keys = set(int(k) for k in keys)
+        groups = {}
+        for key in keys:
+            location = (self.get_model_from_key(key), self.get_database_from_key(key))
+            groups.setdefault(location, []).append(key)
+
+        querysets = [
+            PartitionQuerySet(model=model, actual_model=self.model).using(alias) \
+                .filter(**{'%s__in' % field_name: sorted(group)}).filter(**kwargs)
+            for (model, alias), group in groups.iteritems()
+        ]
+
+        results = dict((key, []) for key in keys)
+        for rows in ScatterQuerySet(self.model, querysets)._execute(list):
+            for obj in rows:
+                results[int(getattr(obj, field_name))].append(obj)
+        return results
+
+    def afilter(self, **kwargs):
+        """
+        Like ``filter``, but runs the query in the background, returning a
+        result whose ``get()`` returns the list of rows.
+
+        >>> result = afilter(poll_id=1)
+        >>> choices = result.get()
+        """
+        queryset = self.filter(**kwargs)
+        return submit(queryset.db, list, queryset)
+
+    def ascatter(self, *args, **kwargs):
+        """
+        Like ``scatter``, but runs the query in the background, see
+        ``ScatterQuerySet.submit``.
+        """
+        return self.scatter(*args, **kwargs).submit()
+
+    def iter_shard(self, shard, chunk_size=5000, fields=None, slave=False):
+        """
+        Lazily iterates over every row of partition ``shard`` in primary key
+        order, fetching ``chunk_size`` rows per query by paging on the primary
+        key, so memory use stays constant however large the partition is.
+
+        If ``fields`` is given, plain tuples of the primary key followed by
+        those fields are yielded instead of model instances.
+
+        >>> for choice in iter_shard(3):
+
+        >>> for pk, votes in iter_shard(3, fields=['votes']):
+        """
+        shards = self.model._shards
+        try:
+            model = shards.partition_models[shard]
+        except IndexError:
+            raise ValueError('Shard %r does not exist on %r' % (shard, self.model.__name__))
+        pk_name = model._meta.pk.name
+
+        for alias in shards.directory.get_partition_databases(shard, slave=slave):
+            queryset = PartitionQuerySet(model=model, actual_model=self.model).using(alias).order_by(pk_name)
+            if fields is not None:
+                queryset = queryset.values_list(pk_name, *fields)
+
+            last_pk = None
+            while True:
+                chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+                rows = list(chunk[:chunk_size])
+                for row in rows:
+                    yield row
+                if len(rows) < chunk_size:
+                    break
+                last_pk = rows[-1][0] if fields is not None else rows[-1].pk
+
+    def iter_all_shards(self, chunk_size=5000, fields=None, slave=False):
+        """
+        Lazily iterates over every row of every partition, one partition at a
+        time (see ``iter_shard``).
+        """
+        for shard in xrange(self.model._shards.num_shards):
+            for row in self.iter_shard(shard, chunk_size=chunk_size, fields=fields, slave=slave):
+                yield row
+
+    def aggregate_all(self, *args, **kwargs):
+        """
+        Aggregates across every partition, see ``ScatterQuerySet.aggregate``.
+
+        >>> aggregate_all(total=Sum('votes'))
+        {'total': 1234}
+        """
+        return self.all_shards().aggregate(*args, **kwargs)
+
+    def count_all(self, *args, **kwargs):
+        """
+        Counts the rows matching the given filter across every partition.
+
+        >>> count_all(votes__gt=0)
+        """
+        return self.scatter(*args, **kwargs).count()
+
+    def bulk_create(self, objs, batch_size=None, parallel=False):
+        """
+        Groups ``objs`` by the partition their key routes to and bulk inserts
+        each group with one multi-row INSERT per ``batch_size`` objects.  The
+        generated ids are set on the given objects.
+
+        If ``parallel`` is True, the partitions are written to concurrently,
+        each committing on its own connection (see ``run_parallel``), which
+        can't be done within a managed transaction.
+
+        >>> bulk_create([Choice(poll_id=1, ...), Choice(poll_id=2, ...)], batch_size=1000)
+        """
+        shards = self.model._shards
+        groups = {}
+        for obj in objs:
+            key = shards.get_key_from_instance(obj)
+            location = (self.get_model_from_key(key), self.get_database_from_key(key))
+            groups.setdefault(location, []).append(obj)
+
+        if parallel and any(transaction.is_managed(using=alias) for model, alias in groups):
+            raise transaction.TransactionManagementError(
+                'Partitions written in parallel would not be part of the managed transaction')
+
+        tasks = []
+        for (model, alias), group in groups.iteritems():
+            queryset = PartitionQuerySet(model=model, actual_model=self.model).using(alias)
+            tasks.append((alias, self._bulk_create_partition, (queryset, group, batch_size)))
+        run_parallel(tasks, max_workers=None if parallel else 1)
+
+        return objs
+
+    def _bulk_create_partition(self, queryset, objs, batch_size):
+        model = queryset.model
+        fields = model._meta.fields
+        instances = [obj if isinstance(obj, model) else model(**dict((f.attname, getattr(obj, f.attname)) for f in fields))
+                     for obj in objs]
+
+        queryset.bulk_create(instances, batch_size=batch_size)
+
+        for obj, instance in zip(objs, instances):
+            if obj is not instance:
+                obj.pk = instance.pk
+                obj._state.db = instance._state.db
+                obj._state.adding = False
 
     def get_query_set(self, key=None):
         shards = self.model._shards
@@ -200,7 +940,10 @@ class MasterPartitionManager(Manager):
                 raise AssertionError('You must filter on %s before expanding a QuerySet on %s models.' % (
                     shards.key, self.model.__name__))
 
-            return getattr(self.get_query_set(key=int(key)), func_name)(**kwargs)
+            key = int(key)
+            if sampler.rate:
+                sampler.sample(self.model, key)
+            return getattr(self.get_query_set(key=key), func_name)(**kwargs)
 
         wrapped.__name__ = func_name
         return wrapped
@@ -15,6 +15,7 @@
 """
 
 import sys
+import threading
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned, ValidationError
@@ -25,10 +26,13 @@ from django.db.models.fields import PositiveIntegerField
 from django.db.models.fields.related import ForeignKey, ManyToOneRel, \
   RECURSIVE_RELATIONSHIP_CONSTANT, ReverseSingleRelatedObjectDescriptor
 from django.db.utils import DatabaseError
+from django.dispatch.dispatcher import _make_id
 
+from sqlshards.db.shards.directory import get_directory
 from sqlshards.db.shards.fields import AutoSequenceField
 from sqlshards.db.shards.helpers import get_sharded_id_sequence_name
 from sqlshards.db.shards.manager import MasterPartitionManager
+from sqlshards.db.shards.objectcache import invalidate_cached_object
 from sqlshards.utils import wraps
 
 
@@ -117,10 +121,62 @@ class PartitionedReverseRelatedObjectDescriptor(ReverseSingleRelatedObjectDescri
             return rel_obj
 
 
+#: Signals partitions re-send to their parent model
+RESENT_SIGNALS = (signals.pre_save, signals.post_save, signals.pre_delete, signals.post_delete,
+                  signals.pre_init, signals.post_init, signals.m2m_changed)
+
+
+def track_receivers(signal):
+    """
+    Wraps ``signal``'s ``connect`` and ``disconnect`` (and the removal of
+    dead weak receivers) to bump ``signal.receivers_version``, so checks for
+    receivers can be cached until the receivers change.
+    """
+    if hasattr(signal, 'receivers_version'):
+        return
+    signal.receivers_version = 0
+
+    def tracked(func):
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                signal.receivers_version += 1
+        return wrapped
+
+    signal.connect = tracked(signal.connect)
+    signal.disconnect = tracked(signal.disconnect)
+    signal._remove_receiver = tracked(signal._remove_receiver)
+
+for signal in RESENT_SIGNALS:
+    track_receivers(signal)
+
+
 def resend_signal(new_sender):
+    """
+    Returns a receiver which re-sends signals as sent by ``new_sender``.
+
+    Nothing is re-sent (nor built) when no receivers are listening for
+    ``new_sender``; this is checked once per change of the signal's receivers
+    (see ``track_receivers``), as ``post_init`` is sent for every row loaded.
+    """
+    sender_id = _make_id(new_sender)
+    # Maps signals to (receivers_version, has receivers)
+    listening = {}
+
     @wraps(new_sender)
-    def wrapped(**kwargs):
-        signal = kwargs.pop('signal')
+    def wrapped(signal, **kwargs):
+        version = signal.receivers_version
+        try:
+            cached_version, has_receivers = listening[signal]
+        except KeyError:
+            cached_version = None
+        if cached_version != version:
+            has_receivers = bool(signal._live_receivers(sender_id))
+            listening[signal] = (version, has_receivers)
+        if not has_receivers:
+            return
         kwargs['sender'] = new_sender
         signal.send(**kwargs)
     return wrapped
@@ -147,11 +203,13 @@ def get_cluster_sizes(connections):
 
 
 DEFAULT_NAMES = ('num_shards', 'key', 'sequence', 'abstract', 'cluster')
+# Options which may be left unset
+OPTIONAL_NAMES = ('cache_ttl',)
 CLUSTER_SIZES = get_cluster_sizes(connections)
 
 
 class MasterShardOptions(object):
-    def __init__(self, options, nodes=[]):
+    def __init__(self, options, nodes=()):
         self.options = options
         self.nodes = nodes
         self.model = None
@@ -179,7 +237,7 @@ class MasterShardOptions(object):
         opts = self.options
 
         if opts:
-            for k in (k for k in DEFAULT_NAMES if hasattr(opts, k)):
+            for k in (k for k in DEFAULT_NAMES + OPTIONAL_NAMES if hasattr(opts, k)):
                 setattr(self, k, getattr(opts, k))
 
         if not hasattr(self, 'sequence'):
@@ -193,6 +251,30 @@ class MasterShardOptions(object):
         if hasattr(self, 'key') and isinstance(self.key, basestring):
             self.key = (self.key,)
 
+    def compile_routes(self):
+        """
+        Flattens the routing information of every partition into sequences
+        indexed by partition number, so routing a query is a couple of
+        index lookups.
+        """
+        if isinstance(self.nodes, PartitionList) and not self.nodes.is_generated():
+            # Partitions are generated through the list as they're routed to
+            self.partition_models = self.nodes
+        else:
+            self.partition_models = tuple(self.nodes)
+        self.partition_databases = tuple(self.get_default_databases(n) for n in xrange(self.num_shards))
+
+    def get_default_databases(self, num):
+        """
+        Returns the ``(master, slave)`` aliases partition ``num`` is placed on
+        by default.
+        """
+        directory = self.directory
+        if not directory.size:
+            return (None, None)
+        host = num % directory.size
+        return (directory.get_alias(host), directory.get_alias(host, slave=True))
+
     def get_key_from_instance(self, instance):
         """
         Return the routing key for an instance.
@@ -250,14 +332,12 @@ class ShardOptions(object):
         return (self.get_database(), self.get_database(slave=True))
 
     def get_database(self, slave=False):
-        parent = self.parent._shards
-        if not parent.size:
-            return
-        alias = parent.cluster
-        if slave:
-            alias += '.slave'
-        alias += '.shard%d' % (self.num % parent.size,)
-        return alias
+        """
+        Returns the database alias this partition is placed on by default.
+        Buckets of the partition which were moved in the directory live
+        elsewhere (see ``ShardDirectory.get_partition_databases``).
+        """
+        return self.databases[slave]
 
     def get_key_from_instance(self, *args, **kwargs):
         return self.parent._shards.get_key_from_instance(*args, **kwargs)
@@ -270,6 +350,9 @@ class ShardOptions(object):
         self.model = cls
         setattr(cls, name, self)
 
+        # (master, slave) aliases, precomputed as they're needed on every query
+        self.databases = self.parent._shards.get_default_databases(self.num)
+
 
 def generate_child_partition(parent, num):
     opts = parent._meta
@@ -299,8 +382,7 @@ def generate_child_partition(parent, num):
 
     # Connect signals so we can re-send them
     signaler = resend_signal(parent)
-    for signal in (signals.pre_save, signals.post_save, signals.pre_delete, signals.post_delete,
-                   signals.pre_init, signals.post_init, signals.m2m_changed):
+    for signal in RESENT_SIGNALS:
         signal.connect(signaler, sender=partition, weak=False)
 
     # Ensure the partition is available within the module scope
@@ -313,6 +395,67 @@ def generate_child_partition(parent, num):
     return partition
 
 
+class PartitionList(object):
+    """
+    The partitions of a master model, indexed by partition number, which are
+    generated (see ``generate_child_partition``) the first time they're
+    accessed.
+    """
+    def __init__(self, parent, num_shards):
+        self.parent = parent
+        self._models = [None] * num_shards
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return u'<%s: parent=%s, generated=%d/%d>' % (
+            self.__class__.__name__, self.parent.__name__,
+            len(self._models) - self._models.count(None), len(self._models))
+
+    def __len__(self):
+        return len(self._models)
+
+    def __iter__(self):
+        for num in xrange(len(self._models)):
+            yield self[num]
+
+    def __getitem__(self, num):
+        if isinstance(num, slice):
+            return [self[n] for n in xrange(*num.indices(len(self._models)))]
+        model = self._models[num]
+        if model is None:
+            model = self.generate(num)
+        return model
+
+    def generate(self, num):
+        if num < 0:
+            num += len(self._models)
+        with self._lock:
+            if self._models[num] is None:
+                self._models[num] = generate_child_partition(self.parent, num)
+            return self._models[num]
+
+    def is_generated(self):
+        return None not in self._models
+
+    def generate_all(self):
+        for num in xrange(len(self._models)):
+            self.generate(num)
+
+
+#: Master models, so their partitions can be generated when needed
+master_models = []
+
+
+def generate_all_partitions():
+    """
+    Generates every partition of every partitioned model, as lazily generated
+    partitions are unknown to ``loading`` until used.
+    """
+    for model in master_models:
+        if isinstance(model._shards.nodes, PartitionList):
+            model._shards.nodes.generate_all()
+
+
 class PartitionDescriptor(ModelBase):
     """
     Creates  partitions from the base model and attaches them to ``cls._shardss``.
@@ -348,11 +491,10 @@ class PartitionDescriptor(ModelBase):
             shardopts = attr_shardopts
         base_shardopts = getattr(new_cls, '_shards', None)
 
-        shards = []
-        new_cls.add_to_class('_shards', MasterShardOptions(shardopts, nodes=shards))
+        new_cls.add_to_class('_shards', MasterShardOptions(shardopts))
 
         if base_shardopts:
-            for k in DEFAULT_NAMES:
+            for k in DEFAULT_NAMES + OPTIONAL_NAMES:
                 if not hasattr(new_cls._shards, k):
                     setattr(new_cls._shards, k, getattr(base_shardopts, k, None))
 
@@ -367,6 +509,10 @@ class PartitionDescriptor(ModelBase):
             if getattr(new_cls._shards, k, None) is None:
                 raise ValidationError('Missing shard configuration value for %r on %r.' % (k, new_cls))
 
+        # Keys are routed to partitions and hosts through the cluster's directory
+        new_cls._shards.directory = get_directory(new_cls._shards.cluster, new_cls._shards.num_shards,
+                                                  new_cls._shards.size)
+
         new_cls.add_to_class('DoesNotExist', subclass_exception('DoesNotExist', (ObjectDoesNotExist,), new_cls.__module__))
         new_cls.add_to_class('MultipleObjectsReturned', subclass_exception('MultipleObjectsReturned', (MultipleObjectsReturned,), new_cls.__module__))
 
@@ -376,13 +522,20 @@ class PartitionDescriptor(ModelBase):
 
         new_cls._really_prepare()
 
-        # We need to create a model for each partition instance which is assigned to the
-        # appropriate table
-        for n in xrange(new_cls._shards.num_shards):
-            partition = generate_child_partition(new_cls, n)
+        # We need a model for each partition instance which is assigned to the
+        # appropriate table.  Unless SHARD_LAZY_PARTITIONS is set these are
+        # created upfront, otherwise on first use.
+        new_cls._shards.nodes = PartitionList(new_cls, new_cls._shards.num_shards)
+        if not getattr(settings, 'SHARD_LAZY_PARTITIONS', False):
+            new_cls._shards.nodes.generate_all()
+        master_models.append(new_cls)
+
+        new_cls._shards.compile_routes()
 
-            # Add to list of partitions for this master
-            shards.append(partition)
+        # Drop cached copies of rows (see ``PartitionQuerySet.get``) as they change
+        if getattr(new_cls._shards, 'cache_ttl', None):
+            for signal in (signals.post_save, signals.post_delete):
+                signal.connect(invalidate_cached_object, sender=new_cls, weak=False)
 
         return new_cls
 
@@ -0,0 +1,142 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+
+class LRUCache(object):
+    """
+    A thread safe in-process cache holding at most ``max_size`` entries,
+    evicting the least recently used first.  Entries expire after their
+    ``ttl`` (in seconds).
+    """
+    def __init__(self, max_size=10000, clock=time.time):
+        self.max_size = max_size
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return None
+            if expires < self.clock():
+                return None
+            # Re-insert to mark as most recently used
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (self.clock() + ttl, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class ObjectCache(object):
+    """
+    Read-through cache for ``get()`` on partitioned models which set
+    ``cache_ttl`` in their ``Shards`` options.
+
+    Rows are cached as ``(partition number, field values)`` under
+    ``(model, shard key, pk)``, in process and optionally in the Django cache
+    named by ``backend``.  Entries are deleted when the object is saved or
+    deleted; other processes' in-process copies live until they expire, as do
+    rows changed through ``QuerySet.update()``.
+
+    Configured with the ``SHARD_OBJECT_CACHE`` setting::
+
+        SHARD_OBJECT_CACHE = {
+            'max_size': 10000,
+            'backend': 'default',
+        }
+    """
+    def __init__(self, max_size=10000, backend=None):
+        self.local = LRUCache(max_size)
+        self.backend = get_cache(backend) if backend else None
+
+    def get_key(self, model, key, pk):
+        return 'sqlshards:obj:%s.%s:%s:%s' % (model._meta.app_label, model._meta.module_name, key, pk)
+
+    def get(self, model, key, pk):
+        cache_key = self.get_key(model, key, pk)
+        value = self.local.get(cache_key)
+        if value is None and self.backend is not None:
+            value = self.backend.get(cache_key)
+            if value is not None:
+                self.local.set(cache_key, value, model._shards.cache_ttl)
+        return value
+
+    def set(self, model, key, pk, value):
+        cache_key = self.get_key(model, key, pk)
+        ttl = model._shards.cache_ttl
+        self.local.set(cache_key, value, ttl)
+        if self.backend is not None:
+            self.backend.set(cache_key, value, ttl)
+
+    def delete(self, model, key, pk):
+        cache_key = self.get_key(model, key, pk)
+        self.local.delete(cache_key)
+        if self.backend is not None:
+            self.backend.delete(cache_key)
+
+    def load(self, model, key, pk, using):
+        """
+        Returns an instance of the cached row, or ``None``.
+        """
+        value = self.get(model, key, pk)
+        if value is None:
+            return None
+        num, values = value
+        obj = model._shards.partition_models[num](*values)
+        obj._state.db = using
+        obj._state.adding = False
+        return obj
+
+    def store(self, model, key, obj):
+        values = tuple(getattr(obj, f.attname) for f in obj._meta.fields)
+        self.set(model, key, obj.pk, (obj._shards.num, values))
+
+
+def invalidate_cached_object(sender, instance, **kwargs):
+    """
+    Receiver for ``post_save`` and ``post_delete`` on the master model
+    (re-sent by each partition).
+    """
+    shards = sender._shards
+    object_cache.delete(sender, shards.get_key_from_instance(instance), instance.pk)
+
+
+object_cache = ObjectCache(**getattr(settings, 'SHARD_OBJECT_CACHE', {}))
@@ -0,0 +1,246 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connections, transaction
+
+_pool = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+# Tasks queued on the pool but not finished, and when the last one finished
+_pending = 0
+_last_active = 0
+
+
+def get_max_workers():
+    """
+    Returns the upper bound on the number of threads used to fan out a query
+    across shards (``SHARD_MAX_WORKERS``, defaults to 8).
+    """
+    return getattr(settings, 'SHARD_MAX_WORKERS', 8)
+
+
+def get_idle_timeout():
+    """
+    Returns the number of seconds the pool may sit idle before its workers
+    close their connections and exit (``SHARD_POOL_IDLE_TIMEOUT``, defaults
+    to 10, or None to keep them forever).
+    """
+    return getattr(settings, 'SHARD_POOL_IDLE_TIMEOUT', 10.0)
+
+
+def run_parallel(tasks, max_workers=None):
+    """
+    Executes ``tasks``, a list of ``(alias, func, args)`` tuples, returning
+    a list of ``func(*args)`` results in the same order as ``tasks``.
+
+    Tasks are run on the shared pool (see ``get_pool``), whose workers keep
+    their connection to ``alias`` open for the next task.  When only a single
+    worker would be used (``max_workers`` or ``SHARD_MAX_WORKERS`` is 1), or
+    when called from one of the pool's workers, the tasks are run inline on
+    the calling thread's connections instead.
+
+    As workers use connections of their own, tasks never take part in the
+    caller's transaction: writes must commit themselves, and anything left
+    uncommitted is rolled back once the task returns.
+
+    >>> run_parallel([('sharded.shard0', list, (qs0,)), ('sharded.shard1', list, (qs1,))])
+    """
+    tasks = list(tasks)
+    if max_workers is None:
+        max_workers = get_max_workers()
+
+    # A worker waiting on tasks queued behind it would deadlock the pool
+    if min(max_workers, len(tasks)) <= 1 or getattr(_local, 'in_pool', False):
+        return [func(*args) for alias, func, args in tasks]
+
+    return get_pool(len(tasks)).map(execute_task, tasks, chunksize=1)
+
+
+def get_pool(tasks=0):
+    """
+    Returns the process wide pool of ``SHARD_MAX_WORKERS`` threads used by
+    ``run_parallel`` and ``submit``, counting ``tasks`` about to be queued on
+    it.  Each worker keeps its connections open between tasks, so the pool
+    doubles as a connection pool for every shard it talks to, until it has
+    been idle for ``SHARD_POOL_IDLE_TIMEOUT`` seconds and is shut down (it's
+    started again when next needed).
+    """
+    global _pool, _pool_size, _pending
+    with _pool_lock:
+        if _pool is None:
+            _pool_size = get_max_workers()
+            _pool = ThreadPool(_pool_size)
+            timeout = get_idle_timeout()
+            if timeout is not None:
+                reaper = threading.Thread(target=reap_pool, args=(_pool, _pool_size, timeout),
+                                          name='ShardPoolReaper')
+                reaper.daemon = True
+                reaper.start()
+        _pending += tasks
+        return _pool
+
+
+def reap_pool(pool, size, timeout):
+    """
+    Shuts ``pool`` down once no task has run on it for ``timeout`` seconds.
+    """
+    global _pool
+    while True:
+        time.sleep(timeout)
+        with _pool_lock:
+            if _pool is not pool:
+                return
+            if _pending or time.time() - _last_active < timeout:
+                continue
+            _pool = None
+        shutdown_pool(pool, size)
+        return
+
+
+def close_pool():
+    """
+    Shuts the shared pool down, closing its workers' connections.  It's
+    started again when next needed.
+    """
+    global _pool
+    with _pool_lock:
+        pool, size, _pool = _pool, _pool_size, None
+    if pool is not None:
+        shutdown_pool(pool, size)
+
+
+class Rendezvous(object):
+    """
+    Blocks each of ``parties`` threads in ``wait`` until all of them have
+    called it.
+    """
+    def __init__(self, parties):
+        self.parties = parties
+        self.arrived = 0
+        self._cond = threading.Condition()
+
+    def wait(self):
+        with self._cond:
+            self.arrived += 1
+            self._cond.notify_all()
+            while self.arrived < self.parties:
+                self._cond.wait()
+
+
+def close_worker_connections(rendezvous):
+    # Holding every worker here ensures each one runs exactly one of these
+    rendezvous.wait()
+    for connection in connections.all():
+        connection.close()
+
+
+def shutdown_pool(pool, size):
+    pool.map(close_worker_connections, [Rendezvous(size)] * size, chunksize=1)
+    pool.close()
+    pool.join()
+
+
+def execute_read(alias, func, args):
+    global _pending, _last_active
+    _local.in_pool = True
+    try:
+        return func(*args)
+    finally:
+        _local.in_pool = False
+        # End the task's transaction (writers commit their own), but keep the
+        # connection for the next task
+        transaction.rollback_unless_managed(using=alias)
+        with _pool_lock:
+            _pending -= 1
+            _last_active = time.time()
+
+
+def execute_task(task):
+    return execute_read(*task)
+
+
+class ImmediateResult(object):
+    """
+    Result of a task which was run inline, with the same interface as
+    ``multiprocessing.pool.AsyncResult``.
+    """
+    def __init__(self, func, args):
+        try:
+            self._value = func(*args)
+            self._exc_info = None
+        except Exception:
+            self._exc_info = sys.exc_info()
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return self._exc_info is None
+
+    def wait(self, timeout=None):
+        pass
+
+    def get(self, timeout=None):
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._value
+
+
+class GatheredResult(object):
+    """
+    Combines several pending results into one, with the same interface as
+    ``multiprocessing.pool.AsyncResult``.  ``get`` returns
+    ``combine(<list of results>)``.
+    """
+    def __init__(self, results, combine=list):
+        self.results = results
+        self.combine = combine
+
+    def ready(self):
+        return all(r.ready() for r in self.results)
+
+    def successful(self):
+        return all(r.successful() for r in self.results)
+
+    def wait(self, timeout=None):
+        for result in self.results:
+            result.wait(timeout)
+
+    def get(self, timeout=None):
+        return self.combine([r.get(timeout) for r in self.results])
+
+
+def submit(alias, func, *args):
+    """
+    Schedules the read ``func(*args)`` against ``alias`` on the shared pool
+    without waiting for it, returning a result whose ``get()`` blocks until
+    it's done.  With a single worker, or from one of the pool's workers, the
+    task is run inline instead.
+
+    >>> result = submit('sharded.shard0', list, queryset)
+    >>> rows = result.get()
+    """
+    if get_max_workers() <= 1 or getattr(_local, 'in_pool', False):
+        return ImmediateResult(func, args)
+    return get_pool(1).apply_async(execute_read, (alias, func, args))
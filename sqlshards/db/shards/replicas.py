@@ -0,0 +1,132 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections, transaction
+
+REPLICA_EXPR = re.compile(r'^(?P<cluster>.+)\.slave\d*\.shard(?P<num>\d+)$')
+
+
+def get_replica_map(aliases):
+    """
+    Returns a dictionary mapping each shard's master alias to the aliases of
+    its replicas (``<cluster>.slave.shardN``, ``<cluster>.slave2.shardN``,
+    etc.).
+    """
+    replicas = {}
+    for alias in sorted(aliases):
+        match = REPLICA_EXPR.match(alias)
+        if not match:
+            continue
+        master = '%s.shard%s' % (match.group('cluster'), match.group('num'))
+        replicas.setdefault(master, []).append(alias)
+    return replicas
+
+
+class ReplicaTracker(object):
+    """
+    Chooses which replica of a shard to read from.
+
+    Keeps an exponential moving average of query latency per replica, fed by
+    ``record`` and by a background thread (see ``start``) which probes each
+    replica with ``SELECT 1`` every ``probe_interval`` seconds. Replicas which
+    are slower than ``max_latency`` are skipped, and replicas which fail a
+    probe are skipped for ``down_interval`` seconds.
+
+    ``choose`` only reads this state, so it never touches the network.
+    """
+    def __init__(self, alpha=0.2, max_latency=None, probe_interval=None, down_interval=None):
+        self.alpha = alpha
+        self.max_latency = max_latency or getattr(settings, 'SHARD_REPLICA_MAX_LATENCY', 0.05)
+        self.probe_interval = probe_interval or getattr(settings, 'SHARD_REPLICA_PROBE_INTERVAL', 5.0)
+        self.down_interval = down_interval or getattr(settings, 'SHARD_REPLICA_DOWN_INTERVAL', 30.0)
+        self.latencies = {}
+        self.down_until = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def record(self, alias, seconds):
+        with self._lock:
+            average = self.latencies.get(alias)
+            if average is None:
+                self.latencies[alias] = seconds
+            else:
+                self.latencies[alias] = average + self.alpha * (seconds - average)
+
+    def mark_down(self, alias):
+        self.down_until[alias] = time.time() + self.down_interval
+
+    def is_available(self, alias, now=None):
+        if self.down_until.get(alias, 0) > (now or time.time()):
+            return False
+        latency = self.latencies.get(alias)
+        return latency is None or latency <= self.max_latency
+
+    def probe(self, alias):
+        start = time.time()
+        try:
+            cursor = connections[alias].cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+            transaction.rollback_unless_managed(using=alias)
+        except Exception:
+            # Connection failures aren't wrapped in DatabaseError
+            self.mark_down(alias)
+            try:
+                connections[alias].close()
+            except Exception:
+                pass
+        else:
+            self.record(alias, time.time() - start)
+
+    def probe_all(self, aliases):
+        for alias in aliases:
+            self.probe(alias)
+
+    def start(self, aliases):
+        """
+        Starts a daemon thread which probes ``aliases`` every
+        ``probe_interval`` seconds. Does nothing if it is already running.
+        """
+        with self._lock:
+            if self._thread is not None or not aliases:
+                return
+            self._thread = threading.Thread(target=self._run, args=(list(aliases),))
+            self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, aliases):
+        while True:
+            self.probe_all(aliases)
+            time.sleep(self.probe_interval)
+
+    def choose(self, replicas):
+        """
+        Returns the fastest available alias of ``replicas``, or None if they
+        are all slow or down.
+        """
+        now = time.time()
+        available = [alias for alias in replicas if self.is_available(alias, now)]
+        if not available:
+            return None
+        return min(available, key=lambda alias: self.latencies.get(alias, 0))
+
+
+tracker = ReplicaTracker()
@@ -14,6 +14,15 @@
    limitations under the License.
 """
 
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from sqlshards.db.shards.replicas import get_replica_map, tracker
+
+
 class ShardedRouter(object):
     """
     Breaks up apps based on their attached shard info.
@@ -21,14 +30,94 @@ class ShardedRouter(object):
     This looks for "_shards" on the model (which is defined as part of PartitionBase)
     and ensures only child tables get synced, as well as guarantees the correct (master)
     database for queries on a given shard.
+
+    Reads made outside of a transaction are sent to the fastest available
+    replica of the shard (``<cluster>.slave.shardN``) when one is configured,
+    unless ``SHARD_READ_FROM_REPLICAS`` is False. A thread which has written
+    to a shard keeps reading from its master for
+    ``SHARD_READ_AFTER_WRITE_WINDOW`` seconds, so it sees its own writes
+    despite replication lag.
     """
+    _replicas = None
+
+    def __init__(self):
+        self._writes = threading.local()
+
     def db_for_read(self, model, **hints):
         shard_info = getattr(model, '_shards', None)
         if shard_info:
             if not shard_info.is_child:
                 raise ValueError('%r cannot be queried as its a virtual partition model' % model.__name__)
-            return shard_info.get_database()
+            key = self.get_key_from_hints(shard_info, hints)
+            if key is not None:
+                database = shard_info.parent._shards.directory.get_database(key)
+            else:
+                database = shard_info.get_database()
+            if hints.get('is_write'):
+                # Only needed to steer reads away from replicas
+                if database in self.get_replicas():
+                    self.record_write(database)
+                return database
+            return self.get_read_database(database)
+
+        return None
+
+    def get_replicas(self):
+        """
+        Returns a dictionary mapping each shard's master alias to the aliases
+        of its replicas, starting to probe them on first use.
+        """
+        if self._replicas is None:
+            if getattr(settings, 'SHARD_READ_FROM_REPLICAS', True):
+                ShardedRouter._replicas = get_replica_map(connections.databases)
+            else:
+                ShardedRouter._replicas = {}
+            tracker.start([alias for aliases in self._replicas.itervalues() for alias in aliases])
+        return self._replicas
+
+    def get_read_database(self, master):
+        """
+        Returns the alias to read from for the shard at ``master``.
+        """
+        replicas = self.get_replicas().get(master)
+        if not replicas:
+            return master
+        # Reads within a transaction must see its writes
+        if transaction.is_managed(using=master) or self.wrote_recently(master):
+            return master
+
+        return tracker.choose(replicas) or master
+
+    def record_write(self, master):
+        writes = getattr(self._writes, 'times', None)
+        if writes is None:
+            writes = self._writes.times = {}
+        writes[master] = time.time()
+
+    def wrote_recently(self, master):
+        """
+        Returns True if this thread wrote to ``master`` within the last
+        ``SHARD_READ_AFTER_WRITE_WINDOW`` seconds.
+        """
+        written = getattr(self._writes, 'times', {}).get(master)
+        if written is None:
+            return False
+        return time.time() - written < getattr(settings, 'SHARD_READ_AFTER_WRITE_WINDOW', 1.0)
 
+    def get_key_from_hints(self, shard_info, hints):
+        """
+        Returns the routing key from the ``instance`` or ``exact_lookups``
+        hints, or None if neither contains it.
+        """
+        try:
+            instance = hints.get('instance')
+            if instance is not None:
+                return shard_info.get_key_from_instance(instance)
+            exact_lookups = hints.get('exact_lookups')
+            if exact_lookups:
+                return shard_info.get_key_from_kwargs(**exact_lookups)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            pass
         return None
 
     def db_for_write(self, model, **hints):
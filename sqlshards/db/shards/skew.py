@@ -0,0 +1,140 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import random
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class SpaceSaving(object):
+    """
+    Tracks the (approximately) most frequent keys of a stream in constant
+    space, using the Space-Saving algorithm.  Counts may be overestimated by
+    at most ``errors[key]``.
+    """
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+
+    def add(self, key, count=1):
+        if key in self.counts:
+            self.counts[key] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = count
+            self.errors[key] = 0
+        else:
+            # Replace the least frequent key, inheriting its count as error
+            smallest = min(self.counts, key=self.counts.get)
+            floor = self.counts.pop(smallest)
+            del self.errors[smallest]
+            self.counts[key] = floor + count
+            self.errors[key] = floor
+
+    def top(self, n=None):
+        return sorted(self.counts.iteritems(), key=lambda i: i[1], reverse=True)[:n]
+
+
+def get_cache_key(model):
+    return 'sqlshards:skew:%s.%s' % (model._meta.app_label, model._meta.module_name)
+
+
+class KeySampler(object):
+    """
+    Samples the routing keys of a partitioned model's queries at ``rate``
+    (0-1), tracking the heaviest keys and the share of queries each partition
+    and host receives.
+
+    Every ``flush_every`` samples the counts are merged into the cache, where
+    ``manage.py shardskew`` reads them from.
+    """
+    def __init__(self, rate=None, capacity=100, flush_every=1000):
+        if rate is None:
+            rate = getattr(settings, 'SHARD_SKEW_SAMPLE_RATE', 0)
+        self.rate = rate
+        self.capacity = capacity
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.models = {}
+
+    def get_counts(self, model):
+        try:
+            return self.models[model]
+        except KeyError:
+            counts = self.models[model] = {
+                'samples': 0,
+                'partitions': {},
+                'hosts': {},
+                'keys': SpaceSaving(self.capacity),
+            }
+            return counts
+
+    def sample(self, model, key):
+        if random.random() >= self.rate:
+            return
+
+        directory = model._shards.directory
+        partition = directory.get_partition(key)
+        host = directory.get_host(key) if directory.hosts is not None else None
+
+        with self._lock:
+            counts = self.get_counts(model)
+            counts['samples'] += 1
+            counts['partitions'][partition] = counts['partitions'].get(partition, 0) + 1
+            counts['hosts'][host] = counts['hosts'].get(host, 0) + 1
+            counts['keys'].add(key)
+            flush = counts['samples'] >= self.flush_every
+            if flush:
+                del self.models[model]
+
+        if flush:
+            merge_into_cache(model, counts, self.capacity)
+
+
+def merge_into_cache(model, counts, capacity=100):
+    """
+    Adds ``counts`` to the totals kept in the cache for ``model``.  Concurrent
+    merges from several processes may lose samples, which is fine for
+    sampling purposes.
+    """
+    key = get_cache_key(model)
+    totals = cache.get(key) or {'samples': 0, 'partitions': {}, 'hosts': {}, 'keys': {}}
+
+    totals['samples'] += counts['samples']
+    for name in ('partitions', 'hosts'):
+        for k, v in counts[name].iteritems():
+            totals[name][k] = totals[name].get(k, 0) + v
+
+    keys = SpaceSaving(capacity)
+    for k, v in totals['keys'].iteritems():
+        keys.add(k, v)
+    for k, v in counts['keys'].counts.iteritems():
+        keys.add(k, v)
+    totals['keys'] = dict(keys.top())
+
+    cache.set(key, totals, getattr(settings, 'SHARD_SKEW_CACHE_TIMEOUT', 86400 * 7))
+
+
+def get_sampled_counts(model):
+    return cache.get(get_cache_key(model))
+
+
+sampler = KeySampler()
@@ -0,0 +1,118 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from sqlshards.db.shards.instrumentation import SHARD_ALIAS_EXPR, combine_by_alias, get_recorded_stats
+
+TABLE_STATS_SQL = """
+SELECT relname, COALESCE(seq_scan, 0) + COALESCE(idx_scan, 0), n_tup_ins + n_tup_upd + n_tup_del, n_live_tup
+FROM pg_stat_user_tables
+"""
+
+DATABASE_STATS_SQL = """
+SELECT xact_commit + xact_rollback, xact_rollback, tup_returned + tup_fetched
+FROM pg_stat_database WHERE datname = current_database()
+"""
+
+
+class Command(BaseCommand):
+    help = 'Reports load per shard and partition table (from PostgreSQL\'s statistics '\
+           'collector), and the queries recorded per shard alias by SHARD_INSTRUMENTATION, '\
+           'flagging shards which are busier than the average.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--threshold', action='store', type='float', dest='threshold', default=1.5,
+                    help='flag shards with more than this many times the average load [default: 1.5]'),
+        make_option('--tables', action='store', type='int', dest='tables', default=5,
+                    help='number of busiest tables to list per shard [default: 5]'),
+    )
+
+    def get_stats(self, alias):
+        cursor = connections[alias].cursor()
+        cursor.execute(DATABASE_STATS_SQL)
+        transactions, rollbacks, rows = cursor.fetchone()
+        cursor.execute(TABLE_STATS_SQL)
+        tables = sorted(cursor.fetchall(), key=lambda r: r[1] + r[2], reverse=True)
+        return {
+            'alias': alias,
+            'transactions': transactions,
+            'rollbacks': rollbacks,
+            'rows': rows,
+            'tables': tables,
+            'load': sum(r[1] + r[2] for r in tables),
+        }
+
+    def handle(self, *args, **options):
+        # Shards placed on the same database share its statistics, so only
+        # report each database once
+        databases = {}
+        for alias in sorted(connections.databases):
+            if not SHARD_ALIAS_EXPR.match(alias):
+                continue
+            settings_dict = connections.databases[alias]
+            key = (settings_dict.get('HOST'), settings_dict.get('PORT'), settings_dict.get('NAME'))
+            databases.setdefault(key, alias)
+
+        stats = [self.get_stats(alias) for alias in sorted(databases.itervalues())]
+        if not stats:
+            self.stdout.write('No shard connections are configured.\n')
+
+        average = float(sum(s['load'] for s in stats)) / len(stats) if stats else 0
+        for s in sorted(stats, key=lambda s: s['load'], reverse=True):
+            ratio = s['load'] / average if average else 0
+            self.stdout.write('%-30s load=%-12d (%.2fx avg)  transactions=%d  rollbacks=%d  rows read=%d%s\n' % (
+                s['alias'], s['load'], ratio, s['transactions'], s['rollbacks'], s['rows'],
+                '  HOT' if ratio > options['threshold'] else ''))
+            for relname, scans, writes, live in s['tables'][:options['tables']]:
+                self.stdout.write('    %-40s scans=%-10d writes=%-10d rows=%d\n' % (relname, scans, writes, live))
+
+        self.write_recorded_stats(options['threshold'], options['tables'])
+
+    def write_recorded_stats(self, threshold, limit):
+        recorded = get_recorded_stats()
+        self.stdout.write('\n')
+        if not recorded:
+            self.stdout.write('No queries were recorded (see SHARD_INSTRUMENTATION and CacheSink).\n')
+            return
+
+        tables = {}
+        for (alias, table), stats in recorded.iteritems():
+            tables.setdefault(alias, []).append((table, stats))
+        aliases = combine_by_alias(recorded)
+
+        self.stdout.write('Recorded queries per alias and partition table:\n')
+        average = float(sum(s.count for s in aliases.itervalues())) / len(aliases)
+        for alias, stats in sorted(aliases.iteritems(), key=lambda i: i[1].count, reverse=True):
+            ratio = stats.count / average if average else 0
+            self.stdout.write('%-30s %s  (%.2fx avg)%s\n' % (
+                alias, self.format_stats(stats), ratio, '  HOT' if ratio > threshold else ''))
+            for table, table_stats in sorted(tables[alias], key=lambda i: i[1].count, reverse=True)[:limit]:
+                self.stdout.write('    %-40s %s\n' % (table or '(unknown)', self.format_stats(table_stats)))
+
+    def format_stats(self, stats):
+        return 'queries=%-10d errors=%d  rows=%d  avg=%.2fms  p50<=%s  p99<=%s' % (
+            stats.count, stats.errors, stats.rows,
+            stats.time / stats.count * 1000 if stats.count else 0,
+            self.format_bound(stats.get_percentile(50)), self.format_bound(stats.get_percentile(99)))
+
+    def format_bound(self, bound):
+        if bound is None:
+            return 'inf'
+        return '%gms' % (bound * 1000,)
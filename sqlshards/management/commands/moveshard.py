@@ -0,0 +1,295 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import os
+import time
+from cStringIO import StringIO
+from optparse import make_option
+
+from django.core.management.base import CommandError, BaseCommand
+from django.db import connections, transaction
+from django.db.models.loading import get_app
+
+from sqlshards.db.shards.helpers import get_partitioned_model
+from sqlshards.db.shards.models import generate_child_partition
+
+
+class Command(BaseCommand):
+    args = '<app>.<model> <partition>'
+    help = 'Streams the rows of a partition table from one database to another '\
+           'in primary key order, resuming from a checkpoint if interrupted. '\
+           'Finishes by comparing the tables a chunk at a time and replaying any '\
+           'rows inserted, updated or deleted while copying.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--source', action='store', dest='source',
+                    help='database alias to copy from [default: the database the partition is placed on]'),
+        make_option('--target', action='store', dest='target',
+                    help='database alias to copy to'),
+        make_option('--buckets', action='store', dest='buckets',
+                    help='comma separated list of directory buckets to copy [default: all rows]'),
+        make_option('--chunk-size', action='store', type='int', dest='chunk_size', default=5000,
+                    help='number of rows to copy per chunk [default: 5000]'),
+        make_option('--sleep', action='store', type='float', dest='sleep', default=0.0,
+                    help='seconds to pause between chunks [default: 0]'),
+        make_option('--checkpoint', action='store', dest='checkpoint',
+                    help='file to record progress in [default: moveshard.<table>.<target>.checkpoint]'),
+        make_option('--no-verify', action='store_false', dest='verify', default=True,
+                    help='skip the final consistency pass'),
+        make_option('--lock-all', action='store_true', dest='lock_all', default=False,
+                    help='repeat the consistency pass over every chunk while the source table is locked '
+                         'against writes, rather than only the last one'),
+    )
+
+    def get_key_filter(self, model, buckets):
+        if not buckets:
+            return ''
+        directory = model._shards.directory
+        qn = self.source.ops.quote_name
+        key_expr = ' + '.join(qn(model._meta.get_field(f).column) for f in model._shards.key)
+        return ' AND (%s) %% %d IN (%s)' % (key_expr, directory.num_buckets, ', '.join(str(b) for b in buckets))
+
+    def read_checkpoint(self, path):
+        if not os.path.exists(path):
+            return None
+        with open(path) as fp:
+            return int(fp.read().strip())
+
+    def write_checkpoint(self, path, last_id):
+        with open(path + '.tmp', 'w') as fp:
+            fp.write('%d\n' % last_id)
+        os.rename(path + '.tmp', path)
+
+    def get_target_max_id(self):
+        cursor = self.target.cursor()
+        cursor.execute('SELECT MAX(%s) FROM %s WHERE TRUE%s' % (self.pk, self.table, self.key_filter))
+        result = cursor.fetchone()[0]
+        transaction.commit_unless_managed(using=self.target.alias)
+        return result
+
+    def copy_chunk(self, last_id):
+        """
+        Copies the next ``chunk_size`` rows after ``last_id``, returning the
+        number of rows copied and the id of the last row.
+        """
+        select = 'SELECT %s FROM %s WHERE %s > %d%s ORDER BY %s LIMIT %d' % (
+            ', '.join(self.columns), self.table, self.pk, last_id, self.key_filter,
+            self.pk, self.chunk_size)
+        return self.copy_select(select, last_id)
+
+    def copy_select(self, select, last_id=None):
+        """
+        Inserts the rows returned by ``select`` on the source into the target,
+        returning the number of rows copied and the id of the last row (or
+        ``last_id`` if there were none).
+        """
+        source_cursor = self.source.cursor()
+        target_cursor = self.target.cursor()
+
+        if hasattr(source_cursor, 'copy_expert') and hasattr(target_cursor, 'copy_expert'):
+            buf = StringIO()
+            source_cursor.copy_expert('COPY (%s) TO STDOUT' % select, buf)
+            lines = buf.getvalue().splitlines()
+            if lines:
+                buf.seek(0)
+                target_cursor.copy_expert('COPY %s (%s) FROM STDIN' % (self.table, ', '.join(self.columns)), buf)
+                last_id = int(lines[-1].split('\t', 1)[0])
+            count = len(lines)
+        else:
+            source_cursor.execute(select)
+            rows = source_cursor.fetchall()
+            if rows:
+                target_cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+                    self.table, ', '.join(self.columns), ', '.join(['%s'] * len(self.columns))), rows)
+                last_id = rows[-1][0]
+            count = len(rows)
+
+        transaction.commit_unless_managed(using=self.target.alias)
+        transaction.commit_unless_managed(using=self.source.alias)
+        return count, last_id
+
+    def get_range_filter(self, low, high):
+        if high is None:
+            return ' AND %s > %d%s' % (self.pk, low, self.key_filter)
+        return ' AND %s > %d AND %s <= %d%s' % (self.pk, low, self.pk, high, self.key_filter)
+
+    def get_chunk_end(self, low):
+        """
+        Returns the id of the ``chunk_size``-th row after ``low`` on the
+        source, or None if there are fewer rows left.
+        """
+        cursor = self.source.cursor()
+        cursor.execute('SELECT %s FROM %s WHERE %s > %d%s ORDER BY %s LIMIT 1 OFFSET %d' % (
+            self.pk, self.table, self.pk, low, self.key_filter, self.pk, self.chunk_size - 1))
+        row = cursor.fetchone()
+        transaction.commit_unless_managed(using=self.source.alias)
+        return row[0] if row else None
+
+    def get_chunk_checksum(self, connection, low, high):
+        """
+        Returns the number of rows with ids in ``(low, high]`` on
+        ``connection`` and a checksum over all of them.
+        """
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*), md5(string_agg(md5(CAST(ROW(%s) AS text)), '' ORDER BY %s)) "
+                       "FROM %s WHERE TRUE%s" % (', '.join(self.columns), self.pk, self.table,
+                                                 self.get_range_filter(low, high)))
+        result = cursor.fetchone()
+        transaction.commit_unless_managed(using=connection.alias)
+        return result
+
+    def get_checksums(self, connection, low, high):
+        """
+        Returns a dictionary mapping the id of each row in ``(low, high]`` on
+        ``connection`` to a checksum of the row.
+        """
+        cursor = connection.cursor()
+        cursor.execute('SELECT %s, md5(CAST(ROW(%s) AS text)) FROM %s WHERE TRUE%s' % (
+            self.pk, ', '.join(self.columns), self.table, self.get_range_filter(low, high)))
+        checksums = dict(cursor.fetchall())
+        transaction.commit_unless_managed(using=connection.alias)
+        return checksums
+
+    def reconcile(self, low, high):
+        """
+        Makes the rows with ids in ``(low, high]`` on the target match the
+        source, returning the number of rows copied and deleted.
+        """
+        source = self.get_checksums(self.source, low, high)
+        target = self.get_checksums(self.target, low, high)
+
+        stale = sorted(pk for pk, checksum in target.iteritems() if source.get(pk) != checksum)
+        missing = sorted(pk for pk, checksum in source.iteritems() if target.get(pk) != checksum)
+
+        if stale:
+            self.target.cursor().execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                self.table, self.pk, ', '.join(['%s'] * len(stale))), stale)
+            transaction.commit_unless_managed(using=self.target.alias)
+        if missing:
+            self.copy_select('SELECT %s FROM %s WHERE %s IN (%s) ORDER BY %s' % (
+                ', '.join(self.columns), self.table, self.pk, ', '.join(str(int(pk)) for pk in missing), self.pk))
+
+        # Updated rows are deleted and copied again
+        return len(missing), len(stale) - len(set(stale).intersection(source))
+
+    def verify_rows(self, low):
+        """
+        Compares the rows after ``low`` a chunk at a time, reconciling chunks
+        whose checksums differ, which replays rows that were updated, deleted,
+        or committed behind the copy's position (e.g. ids reserved in blocks,
+        or long transactions).  Returns the number of rows copied and deleted,
+        and the id the last chunk started after.
+        """
+        copied = deleted = 0
+        while True:
+            high = self.get_chunk_end(low)
+            if self.get_chunk_checksum(self.source, low, high) != self.get_chunk_checksum(self.target, low, high):
+                chunk_copied, chunk_deleted = self.reconcile(low, high)
+                copied += chunk_copied
+                deleted += chunk_deleted
+                self.stdout.write('Reconciled ids after %d: copied %d and deleted %d rows\n' % (
+                    low, chunk_copied, chunk_deleted))
+            if high is None:
+                return copied, deleted, low
+            low = high
+
+    def copy_rows(self, last_id, sleep):
+        total = 0
+        while True:
+            start = time.time()
+            count, last_id = self.copy_chunk(last_id)
+            if not count:
+                break
+            total += count
+            self.write_checkpoint(self.checkpoint, last_id)
+            self.stdout.write('Copied %d rows (%d total, up to id %d) in %.2fs\n' % (
+                count, total, last_id, time.time() - start))
+            if sleep:
+                time.sleep(sleep)
+        return total, last_id
+
+    def handle(self, *args, **options):
+        try:
+            app, model = args[0].split('.')
+            partition = int(args[1])
+        except (IndexError, ValueError):
+            raise CommandError('Expected arguments <app>.<model> <partition>')
+
+        app = get_app(app)
+        model = get_partitioned_model(app, model)
+        self.move(model, partition, **options)
+
+    def move(self, model, partition, **options):
+        if not 0 <= partition < model._shards.num_shards:
+            raise CommandError('Partition %d does not exist on %s' % (partition, model.__name__))
+        child = generate_child_partition(model, partition)
+
+        if not options['target']:
+            raise CommandError('--target is required')
+
+        self.source = connections[options['source'] or child._shards.get_database()]
+        self.target = connections[options['target']]
+        if self.source.alias == self.target.alias:
+            raise CommandError('Source and target must be different databases')
+
+        qn = self.source.ops.quote_name
+        self.table = qn(child._meta.db_table)
+        self.pk = qn(child._meta.pk.column)
+        # The primary key is copied first so the last id of a chunk can be
+        # read back from COPY's output
+        self.columns = [self.pk] + [qn(f.column) for f in child._meta.local_fields if not f.primary_key]
+        self.chunk_size = options['chunk_size']
+
+        buckets = [int(b) for b in options['buckets'].split(',')] if options['buckets'] else []
+        self.key_filter = self.get_key_filter(model, buckets)
+
+        self.checkpoint = options['checkpoint'] or 'moveshard.%s.%s.checkpoint' % (
+            child._meta.db_table, self.target.alias)
+
+        # Rows copied after the last checkpoint was written would otherwise be
+        # copied twice
+        last_id = max(self.read_checkpoint(self.checkpoint) or 0, self.get_target_max_id() or 0)
+        self.stdout.write('Copying %s from %s to %s, starting after id %d\n' % (
+            child._meta.db_table, self.source.alias, self.target.alias, last_id))
+
+        total, last_id = self.copy_rows(last_id, options['sleep'])
+
+        # Catch up on rows inserted while the (throttled) copy was running,
+        # which keeps the locked pass below short.
+        caught_up, last_id = self.copy_rows(last_id, 0)
+
+        self.stdout.write('Finished copying %d rows (%d during catch-up) of %s to %s\n' % (
+            total + caught_up, caught_up, child._meta.db_table, self.target.alias))
+
+        if not options['verify']:
+            return
+
+        # Inserts committed out of id order, updates and deletes aren't seen
+        # by the copy, so compare the tables chunk by chunk while writes go on,
+        # then lock writers out for the last chunk, which the newest rows are
+        # still being written to.  Rows before it updated in the meantime are
+        # only caught with --lock-all.  Writes to the moved buckets must stay
+        # frozen (or be sent to the target) from here until the directory
+        # points at the target.
+        start = time.time()
+        copied, deleted, low = self.verify_rows(0)
+        with transaction.commit_on_success(using=self.source.alias):
+            self.source.cursor().execute('LOCK TABLE %s IN EXCLUSIVE MODE' % self.table)
+            locked = time.time()
+            locked_copied, locked_deleted, low = self.verify_rows(0 if options['lock_all'] else low)
+        self.stdout.write('Verified %s in %.2fs (%.2fs locked): copied %d and deleted %d rows\n' % (
+            child._meta.db_table, time.time() - start, time.time() - locked,
+            copied + locked_copied, deleted + locked_deleted))
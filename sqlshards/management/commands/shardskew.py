@@ -0,0 +1,116 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from optparse import make_option
+
+from django.core.cache import cache
+from django.core.management.base import CommandError, BaseCommand
+from django.db.models.loading import get_app
+
+from sqlshards.db.shards.helpers import get_partitioned_model
+from sqlshards.db.shards.skew import get_cache_key, get_sampled_counts
+
+
+class Command(BaseCommand):
+    args = '<app>.<model>'
+    help = 'Reports how sampled queries on a partitioned model are spread over its '\
+           'partitions and hosts, and which hot keys to move to a less loaded host '\
+           '(requires SHARD_SKEW_SAMPLE_RATE).'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--top', action='store', type='int', dest='top', default=10,
+                    help='number of heaviest keys to list [default: 10]'),
+        make_option('--threshold', action='store', type='float', dest='threshold', default=0.05,
+                    help='suggest moving keys receiving more than this share of queries [default: 0.05]'),
+        make_option('--reset', action='store_true', dest='reset', default=False,
+                    help='discard the samples collected so far'),
+    )
+
+    def write_distribution(self, title, counts, expected, samples):
+        self.stdout.write('%s (%.2fx max/mean imbalance):\n' % (
+            title, max(counts) / (float(samples) / len(counts)) if samples else 0))
+        for name, count in enumerate(counts):
+            self.stdout.write('    %-10s %-10d %6.2f%%  (expected %.2f%%)\n' % (
+                name, count, 100.0 * count / samples, 100.0 * expected))
+
+    def handle(self, *args, **options):
+        try:
+            app, model = args[0].split('.')
+        except (IndexError, ValueError):
+            raise CommandError('Expected argument <app>.<model>')
+
+        model = get_partitioned_model(get_app(app), model)
+
+        if options['reset']:
+            cache.delete(get_cache_key(model))
+            return
+
+        counts = get_sampled_counts(model)
+        if not counts or not counts['samples']:
+            raise CommandError('No samples have been collected for %s; is SHARD_SKEW_SAMPLE_RATE set?' % (
+                model.__name__,))
+
+        samples = counts['samples']
+        directory = model._shards.directory
+        num_shards = directory.num_shards
+
+        self.stdout.write('%d sampled queries on %s\n\n' % (samples, model.__name__))
+
+        partitions = [counts['partitions'].get(p, 0) for p in xrange(num_shards)]
+        self.write_distribution('Partitions', partitions, 1.0 / num_shards, samples)
+
+        hosts = None
+        if directory.hosts is not None:
+            num_hosts = max(directory.hosts) + 1
+            hosts = [counts['hosts'].get(h, 0) for h in xrange(num_hosts)]
+            self.stdout.write('\n')
+            self.write_distribution('Hosts', hosts, 1.0 / num_hosts, samples)
+
+        heavy = sorted(counts['keys'].iteritems(), key=lambda i: i[1], reverse=True)
+        self.stdout.write('\nHeaviest keys:\n')
+        for key, count in heavy[:options['top']]:
+            self.stdout.write('    %-20s %-10d %6.2f%%  partition=%d bucket=%d\n' % (
+                key, count, 100.0 * count / samples, directory.get_partition(key), directory.get_bucket(key)))
+
+        if hosts is None:
+            return
+
+        # Greedily move each hot key's bucket to the least loaded host,
+        # accounting for the load already moved there
+        suggestions = []
+        for key, count in heavy:
+            if float(count) / samples < options['threshold']:
+                break
+            bucket = directory.get_bucket(key)
+            source = directory.get_host(key)
+            target = min(xrange(len(hosts)), key=hosts.__getitem__)
+            if target == source or hosts[target] + count >= hosts[source]:
+                continue
+            hosts[source] -= count
+            hosts[target] += count
+            suggestions.append((key, bucket, source, target))
+
+        self.stdout.write('\n')
+        if not suggestions:
+            self.stdout.write('No keys need moving.\n')
+            return
+
+        self.stdout.write('Suggested moves:\n')
+        for key, bucket, source, target in suggestions:
+            self.stdout.write('    key %s: ./manage.py moveshard %s.%s %d --buckets=%d --source=%s --target=%s\n' % (
+                key, model._meta.app_label, model._meta.module_name, directory.get_partition(key), bucket,
+                directory.get_alias(source), directory.get_alias(target)))
+            self.stdout.write('        then assign bucket %d to host %d in the shard directory\n' % (bucket, target))
@@ -16,15 +16,27 @@
 
 from datetime import datetime
 from optparse import make_option
+import re
+import threading
 import time
 
 from django.conf import settings
 from django.core.management.base import CommandError, BaseCommand
-from django.db import connections
+from django.core.management.color import no_style
+from django.db import connections, transaction
 from django.db.models.loading import get_app
 
-from sqlshards.db.shards.helpers import get_sharded_id_sequence_name
+from sqlshards.db.shards.helpers import get_partitioned_model, get_sharded_id_sequence_name
 from sqlshards.db.shards.models import generate_child_partition
+from sqlshards.db.shards.pool import run_parallel
+
+# Statements creating these objects are skipped if they already exist
+CREATED_OBJECT_EXPRS = (
+    re.compile(r'^CREATE SEQUENCE "?(\w+)"?'),
+    re.compile(r'^CREATE TABLE "(\w+)"'),
+    re.compile(r'^CREATE (?:UNIQUE )?INDEX "(\w+)"'),
+    re.compile(r'^ALTER TABLE "\w+" ADD CONSTRAINT "(\w+)"'),
+)
 
 
 class Command(BaseCommand):
@@ -38,6 +50,9 @@ class Command(BaseCommand):
                     help='physical shard number to generate DDL for (0-based) [default: 0]'),
         make_option('--shards', action='store', type='int', dest='shards', default=1,
                     help='number of physical shards [default: 1]'),
+        make_option('--apply', action='store_true', dest='apply', default=False,
+                    help='execute the DDL against the database each partition is routed to, '
+                         'skipping objects which already exist, rather than printing it'),
         # TODO: suffix
     )
 
@@ -68,12 +83,12 @@ class Command(BaseCommand):
             child = generate_child_partition(model, i)
             if isinstance(child._shards.key, basestring):
                 shard_key_repr = child._shards.key
-                shard_key_expr = '"%s"' % shard_key_repr
+                shard_key_expr = '"%s"' % child._meta.get_field(shard_key_repr).column
             else:
                 shard_key_repr = '_'.join(child._shards.key)
                 # TODO: This sums the keys for the expression right now.
                 # This needs to match the logic in MasterShardOptions.get_key_from_kwargs.
-                shard_key_expr = '("' + '" + "'.join(child._shards.key) + '")'
+                shard_key_expr = '("' + '" + "'.join(child._meta.get_field(f).column for f in child._shards.key) + '")'
 
             constraint_name = "%s_%s_check_modulo" % (child._meta.db_table, shard_key_repr)
             output.append(self.style.SQL_KEYWORD('ALTER TABLE ') +
@@ -118,14 +133,85 @@ $$ LANGUAGE PLPGSQL;""".format(our_epoch=our_epoch)
 
         return output
 
-    def get_partitioned_model(self, app, model):
-        for obj in (getattr(app, x) for x in dir(app)):
-            if not hasattr(obj, '_shards') or not obj._shards.is_master:
-                continue
-
-            if obj._meta.module_name == model:
-                return obj
-        raise ValueError
+    def get_partition_databases(self, model, num):
+        """
+        Returns the aliases partition ``num`` must be created on: where it's
+        placed by default, and wherever its buckets were moved to.
+        """
+        aliases = [generate_child_partition(model, num)._shards.get_database()]
+        directory = model._shards.directory
+        if num < directory.num_shards:
+            aliases.extend(a for a in directory.get_partition_databases(num) if a not in aliases)
+        return aliases
+
+    def get_existing_objects(self, cursor):
+        cursor.execute("SELECT relname FROM pg_class UNION SELECT conname FROM pg_constraint")
+        return set(row[0] for row in cursor.fetchall())
+
+    def get_statement_summary(self, sql):
+        return sql.split('\n', 1)[0][:100]
+
+    def write_progress(self, alias, action, sql):
+        with self.output_lock:
+            self.stdout.write('%s: %s %s\n' % (alias, action, self.get_statement_summary(sql)))
+
+    def apply_statements(self, alias, statements):
+        start = time.time()
+        applied = skipped = 0
+        connection = connections[alias]
+        try:
+            cursor = connection.cursor()
+            existing = self.get_existing_objects(cursor)
+            for sql in statements:
+                match = filter(None, (expr.match(sql) for expr in CREATED_OBJECT_EXPRS))
+                if match and match[0].group(1) in existing:
+                    skipped += 1
+                    self.write_progress(alias, 'skipped', sql)
+                    continue
+                # The DDL is executed as is, so escape it from parameter interpolation
+                cursor.execute(sql.replace('%', '%%'), ())
+                applied += 1
+                self.write_progress(alias, 'applied', sql)
+            transaction.commit_unless_managed(using=alias)
+        except Exception, e:
+            transaction.rollback_unless_managed(using=alias)
+            error = e
+        else:
+            error = None
+
+        report = {'alias': alias, 'applied': applied, 'skipped': skipped,
+                  'seconds': time.time() - start, 'error': error}
+        with self.output_lock:
+            self.stdout.write('%(alias)s: %(applied)d applied, %(skipped)d skipped in %(seconds).2fs\n' % report)
+        return report
+
+    def apply(self, model, num_children, shard_range):
+        """
+        Executes the DDL for ``shard_range`` against every host concurrently,
+        returning a report of each host.
+        """
+        self.style = no_style()
+        self.output_lock = threading.Lock()
+
+        statements, seen = {}, {}
+        for i in shard_range:
+            ddl = self.get_sequences(model, num_children, [i])
+            ddl.extend(self.get_children_table_sql(model, [model], num_children, [i]))
+            for alias in self.get_partition_databases(model, i):
+                # The next_sharded_id function is generated for every partition
+                host_seen = seen.setdefault(alias, set())
+                statements.setdefault(alias, []).extend(sql for sql in ddl if sql not in host_seen)
+                host_seen.update(ddl)
+
+        reports = run_parallel((alias, self.apply_statements, (alias, host_statements))
+                               for alias, host_statements in sorted(statements.iteritems()))
+
+        failed = [r for r in reports if r['error'] is not None]
+        for report in failed:
+            self.stderr.write('%(alias)s: failed with %(error)r\n' % report)
+        if failed:
+            raise CommandError('Failed to apply DDL to %d of %d databases' % (len(failed), len(reports)))
+        return reports
 
     def handle(self, *args, **options):
         try:
@@ -138,11 +224,15 @@ $$ LANGUAGE PLPGSQL;""".format(our_epoch=our_epoch)
         # XXX: We cant use get_model because its now an abstract model
         # model = get_model(app, model)
         app = get_app(app)
-        model = self.get_partitioned_model(app, model)
+        model = get_partitioned_model(app, model)
 
         num_children = options['num_children']
         shard_range = range(options['shard'], num_children, options['shards'])
 
+        if options['apply']:
+            self.apply(model, num_children, shard_range)
+            return
+
         output = self.get_sequences(model, num_children, shard_range)
         output.extend(self.get_children_table_sql(model, [model], num_children, shard_range))
 
@@ -0,0 +1,28 @@
+"""
+   Copyright 2013 DISQUS
+   
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+   
+       http://www.apache.org/licenses/LICENSE-2.0
+   
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from django.core.management.commands.syncdb import Command as SyncDBCommand
+
+from sqlshards.db.shards.models import generate_all_partitions
+
+
+class Command(SyncDBCommand):
+    help = SyncDBCommand.help + ' Partitions of partitioned models are always included, even '\
+           'with SHARD_LAZY_PARTITIONS.'
+
+    def handle_noargs(self, **options):
+        generate_all_partitions()
+        return super(Command, self).handle_noargs(**options)
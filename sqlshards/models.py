@@ -14,3 +14,6 @@
    limitations under the License.
 """
 
+from sqlshards.db.shards.instrumentation import install_from_settings
+
+install_from_settings()
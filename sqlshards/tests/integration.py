@@ -14,13 +14,41 @@
    limitations under the License.
 """
 
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from cStringIO import StringIO
+from optparse import NO_DEFAULT
 from unittest import TestCase as UnitTestCase
-from django.db.models import signals
+from django.core.cache import cache
+from django.db import connections, models, transaction
+from django.db.backends.signals import connection_created
+from django.db.models import Avg, Count, Max, Min, Sum, loading, signals
 from django.test import TestCase
+from django.test.utils import override_settings
+from sqlshards.db.backends.postgresql_psycopg2.base import DatabaseWrapper as SharedDatabaseWrapper
+from sqlshards.db.shards.directory import ShardDirectory
+from sqlshards.db.shards.fields import SequenceBlock
 from sqlshards.db.shards.helpers import get_canonical_model, is_partitioned
+from sqlshards.db.shards.instrumentation import CACHE_KEY, CacheSink, InstrumentedCursor, MemorySink, \
+                                               get_recorded_stats, install, uninstall
+from sqlshards.db.shards.manager import Descending, merge_ordered
+from sqlshards.db.shards.models import PartitionModel, master_models
+from sqlshards.db.shards.objectcache import LRUCache
+from sqlshards.db.shards.pool import close_pool, get_pool, run_parallel
+from sqlshards.db.shards.ids import ShardedIDGenerator, parse_sharded_id
+from sqlshards.db.shards.replicas import ReplicaTracker, get_replica_map
+from sqlshards.db.shards.routers import ShardedRouter
+from sqlshards.db.shards.skew import KeySampler, SpaceSaving
+from sqlshards.management.commands.moveshard import Command as MoveShardCommand
+from sqlshards.management.commands.sqlpartition import Command as SQLPartitionCommand
+from sqlshards.utils import DatabaseConfigurator
 
 from .sample.models import SimpleModel, PartitionedModel, PartitionedModel_Partition0, \
-                           TestModel, CompositeTestModel
+                           TestModel, CompositeTestModel, CachedModel, RelatedModel, ColumnKeyModel
 
 
 class CompositeKeyShardTest(TestCase):
@@ -45,6 +73,29 @@ class PartitionShardTest(TestCase):
         node = TestModel._shards.nodes[0]
         self.assertEqual(node._shards.get_all_databases(), ('sharded.shard0', 'sharded.slave.shard0'))
 
+    def test_routing_tables(self):
+        self.assertEqual(TestModel._shards.partition_models, tuple(TestModel._shards.nodes))
+        self.assertEqual(TestModel._shards.partition_databases, (
+            ('sharded.shard0', 'sharded.slave.shard0'),
+            ('sharded.shard1', 'sharded.slave.shard1'),
+        ))
+
+    def test_resend_signal(self):
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(sender)
+
+        partition = TestModel._shards.nodes[0]
+        partition(key=2)
+        signals.post_init.connect(receiver, sender=TestModel)
+        try:
+            partition(key=2)
+        finally:
+            signals.post_init.disconnect(receiver, sender=TestModel)
+        partition(key=2)
+        self.assertEqual(received, [TestModel])
+
     def test_get_key_from_kwargs(self):
         self.assertEqual(TestModel._shards.get_key_from_kwargs(key=1), 1)
 
@@ -92,6 +143,18 @@ class PartitionTest(TestCase):
         self.assertEqual(TestModel.objects.get_database_from_key(2, slave=True), 'sharded.slave.shard0')
         self.assertEqual(TestModel.objects.get_database_from_key(3, slave=True), 'sharded.slave.shard1')
 
+    def test_get_database_from_key_uses_directory(self):
+        directory = TestModel._shards.directory
+        bucket = directory.get_bucket(2)
+        directory.assign(bucket, 1)
+        try:
+            self.assertEqual(TestModel.objects.get_database_from_key(2), 'sharded.shard1')
+            self.assertEqual(TestModel.objects.get_database_from_key(2 + directory.num_buckets), 'sharded.shard1')
+            self.assertEqual(TestModel.objects.get_database_from_key(4), 'sharded.shard0')
+            self.assertEqual(TestModel.objects.get_model_from_key(2), TestModel._shards.nodes[0])
+        finally:
+            directory.assign(bucket, 0)
+
     def test_get_model_from_key(self):
         self.assertEqual(TestModel.objects.get_model_from_key(2), TestModel._shards.nodes[0])
         self.assertEqual(TestModel.objects.get_model_from_key(3), TestModel._shards.nodes[1])
@@ -118,6 +181,130 @@ class PartitionTest(TestCase):
         queryset = TestModel.objects.shard(1)
         self.assertEqual(queryset.model, TestModel._shards.nodes[1])
 
+    def test_all_shards(self):
+        queryset = TestModel.objects.all_shards()
+        self.assertEqual([qs.model for qs in queryset.querysets], list(TestModel._shards.nodes))
+        self.assertEqual([qs.db for qs in queryset.querysets], ['sharded.shard0', 'sharded.shard1'])
+
+    def test_all_shards_slave(self):
+        queryset = TestModel.objects.all_shards(slave=True)
+        self.assertEqual([qs.db for qs in queryset.querysets], ['sharded.slave.shard0', 'sharded.slave.shard1'])
+
+    @override_settings(SHARD_MAX_WORKERS=1)
+    def test_scatter(self):
+        TestModel.objects.create(key=2, foo='bar')
+        TestModel.objects.create(key=3, foo='bar')
+        TestModel.objects.create(key=3, foo='baz')
+        results = TestModel.objects.scatter(foo='bar')
+        self.assertEqual(sorted(r.key for r in results), [2, 3])
+
+    def test_bulk_create(self):
+        objs = [TestModel(key=2, foo='bar'), TestModel(key=3, foo='bar'), TestModel(key=5, foo='baz')]
+        TestModel.objects.bulk_create(objs, batch_size=1)
+        self.assertTrue(all(o.pk for o in objs))
+        self.assertEqual(TestModel.objects.get(key=2, foo='bar').pk, objs[0].pk)
+        self.assertEqual(TestModel.objects.filter(key=3).count(), 1)
+        self.assertEqual(TestModel.objects.filter(key=5).count(), 1)
+
+    @override_settings(SHARD_MAX_WORKERS=1)
+    def test_get_many(self):
+        TestModel.objects.create(key=2, foo='bar')
+        TestModel.objects.create(key=3, foo='bar')
+        TestModel.objects.create(key=3, foo='baz')
+        results = TestModel.objects.get_many(keys=[2, 3, 4], foo='bar')
+        self.assertEqual(sorted(results.keys()), [2, 3, 4])
+        self.assertEqual([o.foo for o in results[2]], ['bar'])
+        self.assertEqual([o.foo for o in results[3]], ['bar'])
+        self.assertEqual(results[4], [])
+
+    def test_get_many_composite_key(self):
+        self.assertRaises(AssertionError, CompositeTestModel.objects.get_many, keys=[1])
+
+    @override_settings(SHARD_MAX_WORKERS=1)
+    def test_scatter_ordered_slice(self):
+        for key, foo in ((2, 'a'), (3, 'b'), (4, 'c'), (5, 'd'), (7, 'e')):
+            TestModel.objects.create(key=key, foo=foo)
+        queryset = TestModel.objects.all_shards().order_by('-key')
+        self.assertEqual([o.key for o in queryset[1:4]], [5, 4, 3])
+        self.assertEqual(queryset[0].key, 7)
+        self.assertEqual([o.key for o in queryset.after(4)[:2]], [3, 2])
+        self.assertEqual(list(queryset.values_list('key', flat=True)[:2]), [7, 5])
+
+    @override_settings(SHARD_MAX_WORKERS=1)
+    def test_aggregate_all(self):
+        for key in (2, 3, 4, 7):
+            TestModel.objects.create(key=key, foo='bar')
+        self.assertEqual(TestModel.objects.count_all(), 4)
+        self.assertEqual(TestModel.objects.count_all(key__gt=3), 2)
+        self.assertEqual(TestModel.objects.aggregate_all(
+            total=Sum('key'), count=Count('key'), low=Min('key'), high=Max('key'), average=Avg('key')),
+            {'total': 16, 'count': 4, 'low': 2, 'high': 7, 'average': 4.0})
+
+    def test_aggregate_all_distinct(self):
+        self.assertRaises(ValueError, TestModel.objects.aggregate_all, Count('key', distinct=True))
+
+    @override_settings(SHARD_MAX_WORKERS=1)
+    def test_afilter_and_ascatter(self):
+        TestModel.objects.create(key=2, foo='bar')
+        TestModel.objects.create(key=3, foo='bar')
+        result = TestModel.objects.afilter(key=2)
+        self.assertTrue(result.ready())
+        self.assertEqual([o.key for o in result.get()], [2])
+        result = TestModel.objects.ascatter(foo='bar')
+        self.assertEqual(sorted(o.key for o in result.get()), [2, 3])
+
+    def test_iter_shard(self):
+        for key in (2, 4, 6, 3):
+            TestModel.objects.create(key=key, foo='bar')
+        self.assertEqual([o.key for o in TestModel.objects.iter_shard(0, chunk_size=2)], [2, 4, 6])
+        self.assertEqual([row[1:] for row in TestModel.objects.iter_shard(0, chunk_size=2, fields=['key'])],
+                         [(2,), (4,), (6,)])
+        self.assertEqual(sorted(o.key for o in TestModel.objects.iter_all_shards(chunk_size=1)), [2, 3, 4, 6])
+        self.assertRaises(ValueError, list, TestModel.objects.iter_shard(2))
+
+    @override_settings(SHARD_MAX_WORKERS=1)
+    def test_prefetch_partitioned(self):
+        parents = dict((key, TestModel.objects.create(key=key, foo=str(key))) for key in (2, 3, 4))
+        for key, parent in parents.iteritems():
+            RelatedModel.objects.create(key=key, test_id=parent.pk)
+
+        cache_name = RelatedModel._meta.get_field('test').get_cache_name()
+        related = list(RelatedModel.objects.all_shards().prefetch_partitioned('test'))
+        self.assertEqual(len(related), 3)
+        for obj in related:
+            self.assertTrue(hasattr(obj, cache_name))
+            self.assertEqual(obj.test.foo, str(obj.key))
+
+        related = list(RelatedModel.objects.filter(key=2).prefetch_partitioned('test'))
+        self.assertEqual(getattr(related[0], cache_name).pk, parents[2].pk)
+
+    def test_select_related_partitioned(self):
+        parent = TestModel.objects.create(key=3, foo='bar')
+        RelatedModel.objects.create(key=3, test_id=parent.pk)
+
+        using = RelatedModel.objects.get_database_from_key(3)
+        with self.assertNumQueries(1, using=using):
+            obj = RelatedModel.objects.filter(key=3).select_related('test')[0]
+            self.assertEqual(obj.test.foo, 'bar')
+        self.assertEqual(obj.test.__class__, TestModel._shards.nodes[1])
+        self.assertFalse(hasattr(obj, '_test__foo'))
+
+    def test_cached_get(self):
+        obj = CachedModel.objects.create(key=2, foo='bar')
+        using = CachedModel.objects.get_database_from_key(2)
+        self.assertEqual(CachedModel.objects.get(key=2, pk=obj.pk).foo, 'bar')
+        with self.assertNumQueries(0, using=using):
+            cached = CachedModel.objects.get(key=2, pk=obj.pk)
+        self.assertEqual(cached.foo, 'bar')
+        self.assertEqual(cached.__class__, CachedModel._shards.nodes[0])
+
+        # Saving drops the cached copy
+        obj.foo = 'baz'
+        obj.save()
+        self.assertEqual(CachedModel.objects.get(key=2, pk=obj.pk).foo, 'baz')
+        obj.delete()
+        self.assertRaises(CachedModel.DoesNotExist, CachedModel.objects.get, key=2, pk=obj.pk)
+
     def test_missing_key_on_query(self):
         self.assertRaises(AssertionError, TestModel.objects.all)
 
@@ -139,6 +326,49 @@ class PartitionTest(TestCase):
         self.assertEqual(result, TestModel)
 
 
+class LazyPartitionsTestCase(UnitTestCase):
+    def setUp(self):
+        with override_settings(SHARD_LAZY_PARTITIONS=True):
+            class LazyModel(PartitionModel):
+                key = models.IntegerField()
+
+                class Shards:
+                    key = 'key'
+                    num_shards = 4
+                    cluster = 'sharded'
+
+                class Meta:
+                    app_label = 'sample'
+        self.model = LazyModel
+
+    def tearDown(self):
+        # Unregister the model and its partitions
+        master_models.remove(self.model)
+        app_models = loading.cache.app_models['sample']
+        module = sys.modules[self.model.__module__]
+        for name in [n for n in app_models if n.startswith('lazymodel')]:
+            model = app_models.pop(name)
+            if getattr(module, model.__name__, None) is model:
+                delattr(module, model.__name__)
+        loading.cache._get_models_cache.clear()
+
+    def test_generated_on_first_use(self):
+        LazyModel = self.model
+        get_partition = lambda num: loading.get_model('sample', 'lazymodel_partition%d' % (num,),
+                                                      seed_cache=False, only_installed=False)
+        self.assertEqual(get_partition(1), None)
+        self.assertEqual(LazyModel.objects.get_database_from_key(5), 'sharded.shard1')
+        self.assertEqual(get_partition(1), None)
+
+        partition = LazyModel.objects.get_model_from_key(5)
+        self.assertEqual(partition.__name__, 'LazyModel_Partition1')
+        self.assertEqual(get_partition(1), partition)
+        self.assertEqual(get_partition(2), None)
+
+        self.assertEqual([m._shards.num for m in LazyModel._shards.nodes], [0, 1, 2, 3])
+        self.assertEqual(LazyModel._shards.nodes[-1], get_partition(3))
+
+
 class IsPartitionedTestCase(UnitTestCase):
     def test(self):
         self.assertFalse(is_partitioned(SimpleModel))
@@ -151,3 +381,511 @@ class GetCanonicalModelTestCase(UnitTestCase):
         self.assertEqual(get_canonical_model(SimpleModel), SimpleModel)
         self.assertEqual(get_canonical_model(PartitionedModel), PartitionedModel)
         self.assertEqual(get_canonical_model(PartitionedModel_Partition0), PartitionedModel)
+
+
+class ShardedIDGeneratorTestCase(UnitTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.generator = ShardedIDGenerator(epoch=0, clock=lambda: self.now)
+
+    def test_layout(self):
+        value = self.generator.next_id(3, 1025)
+        self.assertEqual(value, (1000000 << 23) | (3 << 10) | 1)
+        self.assertEqual(parse_sharded_id(value, epoch=0), (1000000, 3, 1))
+
+    def test_monotonic_within_millisecond(self):
+        first = self.generator.next_id(1, 1023)
+        second = self.generator.next_id(1, 1024)
+        self.assertTrue(second > first)
+
+    def test_clock_regression(self):
+        first = self.generator.next_id(1, 5)
+        self.now -= 10
+        second = self.generator.next_id(1, 6)
+        self.assertTrue(second > first)
+        self.assertEqual(parse_sharded_id(second, epoch=0)[0], 1000000)
+
+    def test_invalid_shard(self):
+        self.assertRaises(ValueError, self.generator.next_id, 1 << 13, 1)
+
+    def test_interleaved_generators_across_wrap(self):
+        # Two processes sharing a partition's sequence, one value at a time
+        sequence = iter(xrange(1000, 1100))
+        generators = [ShardedIDGenerator(epoch=0, clock=lambda: self.now) for _ in xrange(2)]
+        ids = [generators[i % 2].next_id(1, next(sequence)) for i in xrange(100)]
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_worker_ids(self):
+        value = self.generator.next_worker_id(3, 64 + 5, 6)
+        self.assertEqual(value, (1000000 << 23) | (3 << 10) | (5 << 4))
+        self.assertEqual(self.generator.next_worker_id(3, 5, 6), value + 1)
+
+    def test_worker_counter_overflow(self):
+        ids = [self.generator.next_worker_id(1, 5, 6) for _ in xrange(17)]
+        self.assertEqual(sorted(set(ids)), ids)
+        self.assertEqual(parse_sharded_id(ids[-1], epoch=0), (1000001, 1, 5 << 4))
+
+    def test_interleaved_workers(self):
+        # Two processes with their own slots, generating in the same millisecond
+        generators = [ShardedIDGenerator(epoch=0, clock=lambda: self.now) for _ in xrange(2)]
+        ids = [generators[i % 2].next_worker_id(1, i % 2, 6) for i in xrange(200)]
+        self.assertEqual(len(set(ids)), len(ids))
+
+
+class SequenceBlockTestCase(UnitTestCase):
+    def test_block_allocation(self):
+        fetched = []
+
+        class FakeSequenceBlock(SequenceBlock):
+            def fetch(self, db_alias, sequence):
+                start = len(fetched) * self.size + 1
+                fetched.append((db_alias, sequence))
+                return range(start, start + self.size)
+
+        block = FakeSequenceBlock(3)
+        values = [block.next_value('default', 'foo_seq') for _ in xrange(4)]
+        self.assertEqual(values, [1, 2, 3, 4])
+        self.assertEqual(fetched, [('default', 'foo_seq'), ('default', 'foo_seq')])
+        self.assertEqual(block.get_stats(), {'blocks': 2, 'served': 4, 'unused': 2})
+
+
+class MoveShardTest(TestCase):
+    def setUp(self):
+        self.child = TestModel._shards.nodes[0]
+        self.table = self.child._meta.db_table
+        # The partition only exists on the sharded cluster, so move it to the
+        # default database
+        self.target = connections['default']
+        self.target.cursor().execute(
+            'CREATE TABLE %s (id integer PRIMARY KEY, key integer NOT NULL, foo varchar(32) NULL)' % self.table)
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.directory, 'checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        source = self.child._shards.get_database()
+        connections[source].cursor().execute('DELETE FROM %s' % self.table)
+        transaction.commit_unless_managed(using=source)
+
+    def move(self, **options):
+        command = MoveShardCommand()
+        command.stdout = StringIO()
+        defaults = dict((o.dest, None if o.default is NO_DEFAULT else o.default) for o in command.option_list)
+        defaults.update(target='default', checkpoint=self.checkpoint, **options)
+        command.move(TestModel, 0, **defaults)
+        cursor = self.target.cursor()
+        cursor.execute('SELECT id, key, foo FROM %s ORDER BY id' % self.table)
+        return cursor.fetchall()
+
+    def get_source_rows(self):
+        return [(o.pk, o.key, o.foo) for o in TestModel.objects.shard(0).order_by('pk')]
+
+    def test_move(self):
+        for key in (2, 4, 6):
+            TestModel.objects.create(key=key, foo='bar')
+        self.assertEqual(self.move(), self.get_source_rows())
+
+    def test_replays_changes_behind_checkpoint(self):
+        objs = [TestModel.objects.create(key=key, foo='bar') for key in (2, 4, 6)]
+        self.move(verify=False)
+
+        TestModel.objects.filter(key=2, pk=objs[0].pk).update(foo='baz')
+        TestModel.objects.filter(key=4, pk=objs[1].pk).delete()
+        # Committed late, behind the ids which have already been copied
+        TestModel.objects.filter(key=6, pk=objs[2].pk).delete()
+        TestModel.objects.create(pk=objs[2].pk, key=6, foo='late')
+
+        self.assertNotEqual(self.move(verify=False), self.get_source_rows())
+        # Verified a row at a time, so only the last chunk is locked
+        self.assertEqual(self.move(chunk_size=1), self.get_source_rows())
+
+    def test_lock_all(self):
+        objs = [TestModel.objects.create(key=key, foo='bar') for key in (2, 4)]
+        self.move(verify=False)
+        TestModel.objects.filter(key=2, pk=objs[0].pk).update(foo='baz')
+        self.assertEqual(self.move(chunk_size=1, lock_all=True), self.get_source_rows())
+
+    def test_key_filter_uses_columns(self):
+        command = MoveShardCommand()
+        command.source = connections['sharded']
+        self.assertEqual(command.get_key_filter(ColumnKeyModel, [1, 3]), ' AND ("owner_id") % 4096 IN (1, 3)')
+
+
+class RunParallelTestCase(UnitTestCase):
+    def setUp(self):
+        # Start a pool of the size each test asks for
+        close_pool()
+
+    def tearDown(self):
+        close_pool()
+
+    def query(self, alias):
+        # Whether this worker already had a connection before the query
+        connected = connections[alias].connection is not None
+        cursor = connections[alias].cursor()
+        cursor.execute('SELECT 1')
+        return threading.current_thread().ident, alias, connected
+
+    @override_settings(SHARD_MAX_WORKERS=2)
+    def test_reuses_pool_and_connections(self):
+        aliases = ['sharded.shard0', 'sharded.shard1'] * 4
+        tasks = [(alias, self.query, (alias,)) for alias in aliases]
+        first = run_parallel(tasks)
+        pool = get_pool()
+        second = run_parallel(tasks)
+        self.assertTrue(get_pool() is pool)
+
+        main = threading.current_thread().ident
+        self.assertFalse(any(ident == main for ident, alias, connected in first + second))
+        # Connections opened by the first batch are still open for the second
+        opened = set((ident, alias) for ident, alias, connected in first)
+        self.assertTrue(all(connected for ident, alias, connected in second if (ident, alias) in opened))
+
+    @override_settings(SHARD_MAX_WORKERS=2)
+    def test_nested_runs_inline(self):
+        def nested(alias):
+            return run_parallel([(alias, self.query, (alias,))] * 2)
+
+        results = run_parallel([('sharded.shard0', nested, ('sharded.shard0',))] * 2)
+        for outer in results:
+            self.assertEqual(len(set(ident for ident, alias, connected in outer)), 1)
+
+    @override_settings(SHARD_MAX_WORKERS=2)
+    def test_close_pool_closes_connections(self):
+        tasks = [(alias, self.query, (alias,)) for alias in ['sharded.shard0', 'sharded.shard1'] * 4]
+        run_parallel(tasks)
+        pool = get_pool()
+        close_pool()
+        self.assertFalse(get_pool() is pool)
+        self.assertFalse(any(connected for ident, alias, connected in run_parallel(tasks[:2])))
+
+    @override_settings(SHARD_MAX_WORKERS=2, SHARD_POOL_IDLE_TIMEOUT=0.1)
+    def test_idle_pool_is_shut_down(self):
+        run_parallel([(alias, self.query, (alias,)) for alias in ['sharded.shard0', 'sharded.shard1']])
+        pool = get_pool()
+        time.sleep(0.5)
+        self.assertFalse(get_pool() is pool)
+
+
+class SQLPartitionApplyTest(UnitTestCase):
+    def apply(self):
+        command = SQLPartitionCommand()
+        command.stdout = StringIO()
+        command.stderr = StringIO()
+        command.connection = connections['default']
+        reports = command.apply(ColumnKeyModel, 2, range(2))
+        return reports, command.stdout.getvalue()
+
+    def get_constraints(self):
+        cursor = connections['sharded.shard0'].cursor()
+        cursor.execute("SELECT conname FROM pg_constraint WHERE conname LIKE 'sample_columnkeymodel_%%'")
+        return sorted(row[0] for row in cursor.fetchall())
+
+    @override_settings(SHARD_MAX_WORKERS=1)
+    def test_apply_is_idempotent(self):
+        table = ColumnKeyModel._shards.nodes[0]._meta.db_table
+        first, output = self.apply()
+        self.assertEqual([r['alias'] for r in first], ['sharded.shard0', 'sharded.shard1'])
+        self.assertTrue('applied CREATE OR REPLACE FUNCTION next_sharded_id' in output, output)
+        self.assertTrue('skipped CREATE TABLE "%s"' % table in output, output)
+        constraints = self.get_constraints()
+        self.assertTrue('%s_key_check_modulo' % table in constraints, constraints)
+
+        second, output = self.apply()
+        # Only the function and column defaults, which replace themselves,
+        # are applied again
+        self.assertEqual([r['applied'] for r in second], [2, 2])
+        self.assertEqual([r['error'] for r in second], [None, None])
+        self.assertTrue('skipped ALTER TABLE "%s" ADD CONSTRAINT' % table in output, output)
+        self.assertEqual(self.get_constraints(), constraints)
+
+
+class SharedConnectionTestCase(UnitTestCase):
+    def setUp(self):
+        self.wrappers = []
+        self.created = []
+        connection_created.connect(self.record_created, sender=SharedDatabaseWrapper)
+
+    def tearDown(self):
+        connection_created.disconnect(self.record_created, sender=SharedDatabaseWrapper)
+        for wrapper in self.wrappers:
+            wrapper.close()
+
+    def record_created(self, sender, connection, **kwargs):
+        self.created.append(connection.alias)
+
+    def get_settings(self):
+        settings_dict = connections['sharded'].settings_dict.copy()
+        settings_dict['ENGINE'] = 'sqlshards.db.backends.postgresql_psycopg2'
+        return settings_dict
+
+    def get_wrapper(self, alias):
+        wrapper = SharedDatabaseWrapper(self.get_settings(), alias)
+        self.wrappers.append(wrapper)
+        return wrapper
+
+    def test_aliases_share_connection(self):
+        shard0, shard1 = self.get_wrapper('test.shard0'), self.get_wrapper('test.shard1')
+        shard0.cursor()
+        shard1.cursor()
+        self.assertTrue(shard0.connection is shard1.connection)
+        self.assertEqual(self.created, ['test.shard0', 'test.shard1'])
+
+    def test_threads_are_isolated(self):
+        shard0 = self.get_wrapper('test.shard0')
+        shard0.cursor()
+        connection = []
+
+        def connect():
+            # Wrappers can't be closed from another thread, so don't track it
+            shard1 = SharedDatabaseWrapper(self.get_settings(), 'test.shard1')
+            shard1.cursor()
+            connection.append(shard1.connection)
+            shard1.close()
+
+        thread = threading.Thread(target=connect)
+        thread.start()
+        thread.join()
+        self.assertFalse(connection[0] is shard0.connection)
+
+    def test_transaction_is_shared(self):
+        shard0, shard1 = self.get_wrapper('test.shard0'), self.get_wrapper('test.shard1')
+        shard0.cursor().execute('CREATE TEMPORARY TABLE shared_test (value integer)')
+        shard0.cursor().execute('INSERT INTO shared_test VALUES (1)')
+
+        cursor = shard1.cursor()
+        cursor.execute('SELECT COUNT(*) FROM shared_test')
+        self.assertEqual(cursor.fetchone()[0], 1)
+
+        # Rolling back through one alias rolls back the other's work too
+        shard1.cursor().execute('INSERT INTO shared_test VALUES (2)')
+        shard0._rollback()
+        cursor = shard1.cursor()
+        cursor.execute("SELECT COUNT(*) FROM pg_class WHERE relname = 'shared_test'")
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+
+class ShardDirectoryTestCase(UnitTestCase):
+    def test_default_layout_matches_modulo(self):
+        directory = ShardDirectory('sharded', 4, 2, num_buckets=16)
+        for key in xrange(64):
+            self.assertEqual(directory.get_partition(key), key % 4)
+            self.assertEqual(directory.get_database(key), 'sharded.shard%d' % (key % 4 % 2))
+        self.assertEqual(directory.get_locations(), [(0, 0), (1, 1), (2, 0), (3, 1)])
+
+    def test_assign(self):
+        directory = ShardDirectory('sharded', 4, 2, num_buckets=16, hosts={5: 2})
+        self.assertEqual(directory.get_database(5), 'sharded.shard2')
+        self.assertEqual(directory.get_database(21, slave=True), 'sharded.slave.shard2')
+        self.assertEqual(directory.get_database(1), 'sharded.shard1')
+        self.assertEqual(directory.get_partition_databases(1), ['sharded.shard1', 'sharded.shard2'])
+        self.assertEqual(directory.get_buckets(host=2), [5])
+
+    def test_invalid_bucket_count(self):
+        self.assertRaises(ValueError, ShardDirectory, 'sharded', 3, 2, num_buckets=16)
+
+
+class ReplicaTrackerTestCase(UnitTestCase):
+    def setUp(self):
+        self.tracker = ReplicaTracker(max_latency=0.05, probe_interval=60, down_interval=60)
+        self.replicas = ['sharded.slave.shard0', 'sharded.slave2.shard0']
+
+    def test_get_replica_map(self):
+        self.assertEqual(get_replica_map(['sharded.shard0', 'sharded.slave.shard0', 'sharded.slave2.shard0',
+                                          'sharded.slave.shard1', 'default']), {
+            'sharded.shard0': ['sharded.slave.shard0', 'sharded.slave2.shard0'],
+            'sharded.shard1': ['sharded.slave.shard1'],
+        })
+
+    def test_choose_fastest(self):
+        self.tracker.record('sharded.slave.shard0', 0.02)
+        self.tracker.record('sharded.slave2.shard0', 0.01)
+        self.assertEqual(self.tracker.choose(self.replicas), 'sharded.slave2.shard0')
+
+    def test_skips_slow_and_down_replicas(self):
+        self.tracker.record('sharded.slave.shard0', 0.5)
+        self.tracker.mark_down('sharded.slave2.shard0')
+        self.assertEqual(self.tracker.choose(self.replicas), None)
+
+    def test_probe_failure_marks_down(self):
+        self.tracker.probe('sharded.shard0')
+        self.assertTrue(self.tracker.is_available('sharded.shard0'))
+        self.tracker.probe('missing.shard0')
+        self.assertFalse(self.tracker.is_available('missing.shard0'))
+
+
+class ReadAfterWriteTestCase(UnitTestCase):
+    def setUp(self):
+        self.router = ShardedRouter()
+        self.router._replicas = {'sharded.shard0': ['sharded.slave.shard0']}
+        self.model = TestModel._shards.nodes[0]
+
+    def test_reads_from_master_after_write(self):
+        self.assertEqual(self.router.db_for_read(self.model), 'sharded.slave.shard0')
+        self.assertEqual(self.router.db_for_write(self.model), 'sharded.shard0')
+        self.assertEqual(self.router.db_for_read(self.model), 'sharded.shard0')
+
+    def test_window_expires(self):
+        self.router.db_for_write(self.model)
+        with override_settings(SHARD_READ_AFTER_WRITE_WINDOW=0):
+            self.assertEqual(self.router.db_for_read(self.model), 'sharded.slave.shard0')
+
+    def test_writes_are_per_thread(self):
+        self.router.db_for_write(self.model)
+        results = []
+        thread = threading.Thread(target=lambda: results.append(self.router.db_for_read(self.model)))
+        thread.start()
+        thread.join()
+        self.assertEqual(results, ['sharded.slave.shard0'])
+
+
+class SkewSamplerTestCase(UnitTestCase):
+    def test_space_saving(self):
+        counter = SpaceSaving(capacity=2)
+        for key in (1, 1, 1, 2, 3, 1):
+            counter.add(key)
+        self.assertEqual(counter.top(1), [(1, 4)])
+        # 3 replaced 2, inheriting its count
+        self.assertEqual(counter.counts[3], 2)
+        self.assertEqual(counter.errors[3], 1)
+
+    def test_sample(self):
+        sampler = KeySampler(rate=1, flush_every=100)
+        for key in (1, 1, 2, 3):
+            sampler.sample(PartitionedModel, key)
+        counts = sampler.models[PartitionedModel]
+        self.assertEqual(counts['samples'], 4)
+        self.assertEqual(counts['partitions'], {1: 3, 0: 1})
+        self.assertEqual(counts['keys'].top(1), [(1, 2)])
+
+    def test_disabled(self):
+        sampler = KeySampler(rate=0)
+        sampler.sample(PartitionedModel, 1)
+        self.assertEqual(sampler.models, {})
+
+
+class LRUCacheTestCase(UnitTestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = LRUCache(max_size=2, clock=lambda: self.now)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.set('a', 1, 60)
+        self.cache.set('b', 2, 60)
+        self.cache.get('a')
+        self.cache.set('c', 3, 60)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(len(self.cache), 2)
+
+    def test_expires(self):
+        self.cache.set('a', 1, 60)
+        self.now = 61
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(len(self.cache), 0)
+
+
+class DatabaseConfiguratorTestCase(UnitTestCase):
+    def get_databases(self, shards):
+        return dict(DatabaseConfigurator({
+            'sharded': {
+                'NAME': 'sharded',
+                'SHARDS': shards,
+                'HOSTS': {
+                    0: {'HOST': 'db0'},
+                    1: {'HOST': 'db1'},
+                },
+            },
+        }, {'ENGINE': 'django.db.backends.postgresql_psycopg2'}))
+
+    def test_shards(self):
+        databases = self.get_databases({'size': 4})
+        self.assertEqual(sorted(databases), ['sharded', 'sharded.shard0', 'sharded.shard1',
+                                             'sharded.shard2', 'sharded.shard3'])
+        self.assertEqual(databases['sharded.shard2']['HOST'], 'db0')
+        self.assertEqual(databases['sharded.shard3']['HOST'], 'db1')
+        self.assertEqual(databases['sharded.shard3']['ENGINE'], 'django.db.backends.postgresql_psycopg2')
+
+    def test_multiplex(self):
+        databases = self.get_databases({'size': 4, 'multiplex': True})
+        self.assertEqual(databases['sharded.shard3']['ENGINE'], 'sqlshards.db.backends.postgresql_psycopg2')
+        self.assertEqual(databases['sharded']['ENGINE'], 'django.db.backends.postgresql_psycopg2')
+
+
+class MergeOrderedTestCase(UnitTestCase):
+    def test_merge(self):
+        result = merge_ordered([[1, 4, 7], [], [2, 3, 9], [5]], key=lambda x: x)
+        self.assertEqual(list(result), [1, 2, 3, 4, 5, 7, 9])
+
+    def test_merge_descending(self):
+        result = merge_ordered([[(7, 'a'), (1, 'b')], [(3, 'a'), (3, 'c')]],
+                               key=lambda x: (Descending(x[0]), x[1]))
+        self.assertEqual(list(result), [(7, 'a'), (3, 'a'), (3, 'c'), (1, 'b')])
+
+
+class InstrumentationTestCase(UnitTestCase):
+    def setUp(self):
+        self.sink = MemorySink()
+        install(self.sink)
+
+    def tearDown(self):
+        uninstall()
+
+    def test_instrumented_cursor(self):
+        class Cursor(object):
+            rowcount = 3
+
+            def execute(self, sql, params):
+                if 'missing' in sql:
+                    raise ValueError(sql)
+
+        cursor = InstrumentedCursor(Cursor(), 'sharded.shard1')
+        cursor.execute('SELECT * FROM "sample_testmodel_1" WHERE "key" = %s', (1,))
+        cursor.execute('UPDATE "sample_testmodel_1" SET "foo" = %s', ('bar',))
+        self.assertRaises(ValueError, cursor.execute, 'SELECT * FROM missing')
+
+        stats = self.sink.stats[('sharded.shard1', 'sample_testmodel_1')]
+        self.assertEqual((stats.count, stats.rows, stats.errors), (2, 6, 0))
+        self.assertEqual(self.sink.stats[('sharded.shard1', 'missing')].errors, 1)
+
+        combined = self.sink.get_alias_stats()['sharded.shard1']
+        self.assertEqual(combined.count, 3)
+        self.assertEqual(sum(combined.histogram), 3)
+        self.assertEqual(combined.get_percentile(100), 0.001)
+
+
+class InstrumentedConnectionTest(TestCase):
+    def tearDown(self):
+        uninstall()
+
+    def test_records_queries_on_shard_connections(self):
+        sink = MemorySink()
+        # The connection is already open, so nothing relies on connection_created
+        TestModel.objects.filter(key=2).count()
+        install(sink)
+        TestModel.objects.create(key=2, foo='bar')
+        self.assertEqual(TestModel.objects.filter(key=2).count(), 1)
+        connections['default'].cursor().execute('SELECT 1')
+
+        alias = TestModel.objects.get_database_from_key(2)
+        self.assertEqual(sink.get_alias_stats()[alias].count, 2)
+        self.assertEqual(sink.stats[(alias, 'sample_testmodel_0')].count, 2)
+        self.assertFalse('default' in sink.get_alias_stats())
+        self.assertEqual(get_recorded_stats()[(alias, 'sample_testmodel_0')].count, 2)
+
+        uninstall()
+        TestModel.objects.filter(key=2).count()
+        self.assertEqual(sink.get_alias_stats()[alias].count, 2)
+
+    def test_cache_sink(self):
+        cache.delete(CACHE_KEY)
+        sink = CacheSink(flush_every=2)
+        install(sink)
+        TestModel.objects.filter(key=3).count()
+        TestModel.objects.filter(key=3).count()
+        uninstall()
+        key = (TestModel.objects.get_database_from_key(3), TestModel._shards.nodes[1]._meta.db_table)
+        self.assertEqual(sink.pending, 0)
+        self.assertEqual(cache.get(CACHE_KEY)[key].count, 2)
+        self.assertEqual(get_recorded_stats()[key].count, 2)
+        cache.delete(CACHE_KEY)
@@ -15,7 +15,7 @@
 """
 
 from django.db import models
-from sqlshards.db.shards.models import PartitionModel
+from sqlshards.db.shards.models import PartitionModel, PartitionedForeignKey
 
 
 class SimpleModel(models.Model):
@@ -55,3 +55,33 @@ class CompositeTestModel(PartitionModel):
 
     class Meta:
         unique_together = (('key', 'foo'),)
+
+
+class CachedModel(PartitionModel):
+    key = models.IntegerField()
+    foo = models.CharField(null=True, max_length=32)
+
+    class Shards:
+        key = 'key'
+        num_shards = 2
+        cluster = 'sharded'
+        cache_ttl = 60
+
+
+class RelatedModel(PartitionModel):
+    key = models.IntegerField()
+    test = PartitionedForeignKey(TestModel)
+
+    class Shards:
+        key = 'key'
+        num_shards = 2
+        cluster = 'sharded'
+
+
+class ColumnKeyModel(PartitionModel):
+    key = models.IntegerField(db_column='owner_id')
+
+    class Shards:
+        key = 'key'
+        num_shards = 2
+        cluster = 'sharded'
@@ -26,7 +26,15 @@ class DatabaseConfigurator(object):
     Additionally it handles a field called HOSTS, which is only used in conjuction
     with SHARDS. If this is set, it will handle mapping the underlying shards
     to other physical machines so that a shard's host is hosts[<shard number> % <num hosts>].
+
+    If SHARDS contains ``'multiplex': True``, the PostgreSQL shard connections
+    use the sqlshards backend, which shares one connection between all shards
+    placed on the same host.
     """
+    MULTIPLEXED_ENGINES = {
+        'django.db.backends.postgresql_psycopg2': 'sqlshards.db.backends.postgresql_psycopg2',
+    }
+
     def __init__(self, settings, defaults={}):
         self.settings = settings
         self.defaults = defaults
@@ -66,6 +74,10 @@ class DatabaseConfigurator(object):
 
                 shard_n_config = hosts[host_num].copy()
 
+                if shard_info.get('multiplex'):
+                    engine = shard_n_config.get('ENGINE')
+                    shard_n_config['ENGINE'] = self.MULTIPLEXED_ENGINES.get(engine, engine)
+
                 # test mirror can vary if its referencing a clustered connection
                 if not shard_n_config.get('TEST_MIRROR'):
                     shard_n_config['TEST_MIRROR'] = alias